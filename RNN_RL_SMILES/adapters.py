@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import math
+import torch
+import torch.nn as nn
+from torch.nn.utils import parametrize
+
+from model import stacked_state_dict
+
+
+class LowRankDelta(nn.Module):
+    """Parametrization that adds a trainable low-rank update scale * B A to a
+       frozen weight. B starts at zero, so an adapted model starts out
+       identical to the prior.
+
+        Args:
+                out_features, in_features : shape of the adapted weight
+                rank : rank of the update
+                alpha : the update is scaled by alpha / rank
+    """
+    def __init__(self, out_features, in_features, rank, alpha):
+        super(LowRankDelta, self).__init__()
+        self.lora_A = nn.Parameter(torch.empty(rank, in_features))
+        self.lora_B = nn.Parameter(torch.zeros(out_features, rank))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.scale = alpha / rank
+
+    def forward(self, weight):
+        return weight + self.scale * (self.lora_B @ self.lora_A)
+
+
+def _adapted_weights(rnn):
+    """Yields (module, prefix, name) of the GRU input/hidden matrices and the output layer weight"""
+    for prefix, module in rnn.named_modules():
+        if isinstance(module, nn.GRU):
+            names = [name for name in module._flat_weights_names if name.startswith('weight_')]
+        elif isinstance(module, nn.GRUCell):
+            names = ['weight_ih', 'weight_hh']
+        elif isinstance(module, nn.Linear):
+            names = ['weight']
+        else:
+            continue
+        for name in names:
+            yield module, prefix, name
+
+
+def add_adapters(rnn, rank=8, alpha=16):
+    """
+    Freezes every parameter of a MultiGRU or StackedGRU and adds a LowRankDelta
+    to the input and hidden matrices of each GRU layer and to the linear layer
+    Args:
+        rnn: MultiGRU or StackedGRU holding the prior weights
+        rank: rank of the updates
+        alpha: the updates are scaled by alpha / rank
+
+    Returns: list of the adapter parameters, the only ones left to train
+
+    """
+    for param in rnn.parameters():
+        param.requires_grad = False
+    params = []
+    for module, _, name in list(_adapted_weights(rnn)):
+        weight = getattr(module, name)
+        delta = LowRankDelta(weight.size(0), weight.size(1), rank, alpha).to(weight.device)
+        parametrize.register_parametrization(module, name, delta)
+        params += [delta.lora_A, delta.lora_B]
+    return params
+
+
+def adapter_state_dict(rnn):
+    """
+    Returns only the adapters of a model set up with add_adapters. The keys
+    are the names of the adapted weights in the StackedGRU layout, followed by
+    .lora_A or .lora_B, with the scale folded into lora_B. Read back with
+    merge_adapters.
+    """
+    lora_A, lora_B = {}, {}
+    for module, prefix, name in _adapted_weights(rnn):
+        if not parametrize.is_parametrized(module, name):
+            continue
+        delta = module.parametrizations[name][0]
+        key = '{}.{}'.format(prefix, name)
+        lora_A[key] = delta.lora_A.detach()
+        lora_B[key] = delta.scale * delta.lora_B.detach()
+    state_dict = {}
+    for key, value in stacked_state_dict(lora_A).items():
+        state_dict[key + '.lora_A'] = value
+    for key, value in stacked_state_dict(lora_B).items():
+        state_dict[key + '.lora_B'] = value
+    return state_dict
+
+
+def is_adapter_state_dict(state_dict):
+    return any(key.endswith('.lora_A') for key in state_dict)
+
+
+def merge_adapters(state_dict, adapters):
+    """
+    Adds the low-rank updates of an adapter checkpoint to the prior weights
+    Args:
+        state_dict: prior checkpoint of either layout
+        adapters: checkpoint written from adapter_state_dict
+
+    Returns: dense state dict in the StackedGRU layout, which loads into either
+             MultiGRU or StackedGRU and samples as fast as the prior
+
+    """
+    merged = stacked_state_dict(state_dict)
+    for key, lora_A in adapters.items():
+        if key.endswith('.lora_A'):
+            name = key[:-len('.lora_A')]
+            lora_B = adapters[name + '.lora_B']
+            merged[name] = merged[name] + (lora_B @ lora_A).to(merged[name].dtype)
+    return merged
+
+
+def dense_state_dict(rnn):
+    """Returns the state dict of rnn with any adapters applied to their weights, as a plain checkpoint"""
+    state_dict = rnn.state_dict()
+    dense = state_dict.__class__()
+    for key, value in state_dict.items():
+        if '.parametrizations.' not in key:
+            dense[key] = value
+    for module, prefix, name in _adapted_weights(rnn):
+        if parametrize.is_parametrized(module, name):
+            dense['{}.{}'.format(prefix, name)] = getattr(module, name).detach()
+    return dense
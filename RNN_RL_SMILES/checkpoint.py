@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import os
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+
+class CheckpointWriter():
+    """Writes checkpoints from a background thread so that saving never blocks
+       training. save() only snapshots the tensors to the CPU; the thread then
+       writes the snapshot to a temporary file next to path and renames it over
+       path, so a crash mid-write never leaves a truncated checkpoint. If a new
+       snapshot arrives before the previous one is written, only the newest is
+       kept. The last keep checkpoints are kept as path, path.1, ..., path.{keep-1}.
+
+        Args:
+                path : location of the checkpoint
+                keep : number of checkpoints to keep
+    """
+    def __init__(self, path, keep=1):
+        self.path = path
+        self.keep = keep
+        self._pending = None
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, state_dict):
+        """Snapshots state_dict and queues it to be written"""
+        snapshot = snapshot_state(state_dict)
+        with self._condition:
+            self._raise_error()
+            self._pending = snapshot
+            self._condition.notify()
+
+    def wait(self):
+        """Blocks until every queued snapshot has been written"""
+        with self._condition:
+            while self._pending is not None:
+                self._condition.wait()
+            self._raise_error()
+
+    def close(self):
+        """Writes the last queued snapshot and stops the writer thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                snapshot = self._pending
+            try:
+                self._write(snapshot)
+            except Exception as error:
+                with self._condition:
+                    self._error = error
+            with self._condition:
+                if self._pending is snapshot:
+                    self._pending = None
+                self._condition.notify_all()
+
+    def _write(self, snapshot):
+        tmp_path = '{}.tmp{}'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            torch.save(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        for i in range(self.keep - 1, 1, -1):
+            older = '{}.{}'.format(self.path, i - 1)
+            if os.path.exists(older):
+                os.replace(older, '{}.{}'.format(self.path, i))
+        if self.keep > 1 and os.path.exists(self.path):
+            # Link the current checkpoint to path.1 instead of moving it, so path exists throughout
+            link_path = '{}.1.tmp{}'.format(self.path, os.getpid())
+            try:
+                os.link(self.path, link_path)
+            except OSError:
+                shutil.copy2(self.path, link_path)
+            os.replace(link_path, '{}.1'.format(self.path))
+        os.replace(tmp_path, self.path)
+
+
+def snapshot_state(obj):
+    """Copies every tensor in a nested state to the CPU so later in-place updates do not change it"""
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        return obj.__class__((key, snapshot_state(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(snapshot_state(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    """Returns the state of the python, numpy and torch random number generators"""
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restores the random number generators from get_rng_state"""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def run_state(model, optimizer, lr_decay, sampler, epoch, step, **extra):
+    """
+    Collects everything needed to resume a training run exactly where it stopped
+    Args:
+        model: nn.Module being trained
+        optimizer: its optimizer, including the Adam moments and current learning rate
+        lr_decay: LearningRateDecay of the run
+        sampler: seeded BucketBatchSampler of the run
+        epoch: epoch to resume in
+        step: number of batches of that epoch already trained on
+        **extra: any other state of the training loop
+
+    Returns: dict to be saved with CheckpointWriter and passed to restore_run_state
+
+    """
+    return {'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'lr_decay_samples': lr_decay.samples,
+            'sampler_seed': sampler.seed,
+            'epoch': epoch,
+            'step': step,
+            'rng': get_rng_state(),
+            'extra': extra}
+
+
+def restore_run_state(state, model, optimizer, lr_decay, sampler):
+    """
+    Restores a run saved with run_state
+    Args:
+        state: dict returned by run_state, as loaded with torch.load
+        model, optimizer, lr_decay, sampler: objects of the new run to restore
+
+    Returns: (epoch, step, extra) where training resumes
+
+    """
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    lr_decay.samples = state['lr_decay_samples']
+    sampler.seed = state['sampler_seed']
+    set_rng_state(state['rng'])
+    return state['epoch'], state['step'], state['extra']
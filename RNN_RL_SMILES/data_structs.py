@@ -7,9 +7,9 @@ import sys
 import time
 import math
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+from torch.nn.utils.rnn import pad_sequence
 
-from utils import Variable
 
 class Vocabulary(object):
     """A class for handling encoding/decoding from SMILES to an array of indices"""
@@ -102,22 +102,225 @@ class MolData(Dataset): ### change to SELFIES
         tokenized = self.voc.tokenize(mol)
         encoded = self.voc.encode(tokenized)
         if encoded is not None:
-            return Variable(encoded)
+            return torch.from_numpy(encoded.astype(np.int64))
 
     def __len__(self):
         return len(self.smiles)
 
+    def lengths(self):
+        """Returns the number of tokens of every sequence in the dataset"""
+        return [len(self.voc.tokenize(mol)) for mol in self.smiles]
+
     def __str__(self):
         return "Dataset containing {} structures.".format(len(self))
 
     @classmethod
     def collate_fn(cls, arr):
-        """Function to take a list of encoded sequences and turn them into a batch"""
-        max_length = max([seq.size(0) for seq in arr])
-        collated_arr = Variable(torch.zeros(len(arr), max_length))
-        for i, seq in enumerate(arr):
-            collated_arr[i, :seq.size(0)] = seq
-        return collated_arr
+        """Function to take a list of encoded sequences and turn them into a
+           zero padded (batch_size * max_length) long tensor and the length of
+           each sequence, to mask the padding in RNN.likelihood. The batch
+           stays on the CPU so it can be built in DataLoader workers and pinned."""
+        seq_lens = torch.LongTensor([len(seq) for seq in arr])
+        return pad_sequence(arr, batch_first=True), seq_lens
+
+
+TOKEN_DTYPE = np.int16
+
+class TokenizedMolData(MolData):
+    """PyTorch Dataset over a SMILES file compiled with compile_mol_data.
+       The token file and offsets index are memory-mapped, so no parsing is
+       done per item and several processes share one page-cached copy.
+
+        Args:
+                prefix : path prefix given to compile_mol_data
+
+        Returns:
+                A Dataset returning (seq_length) int64 tensors of token indices.
+    """
+    def __init__(self, prefix):
+        self.tokens = np.memmap(prefix + '.tok', dtype=TOKEN_DTYPE, mode='r')
+        self.offsets = np.load(prefix + '.idx.npy', mmap_mode='r')
+
+    def __getitem__(self, i):
+        encoded = self.tokens[self.offsets[i]:self.offsets[i + 1]]
+        return torch.from_numpy(encoded.astype(np.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        """Returns the number of tokens of every sequence in the dataset"""
+        return np.diff(self.offsets)
+
+
+class FeatureCache(Dataset):
+    """Dataset of the top GRU layer outputs of every molecule of a dataset,
+       computed once with a frozen model by build(). Training only the linear
+       layer on these is the same as training it behind the frozen GRU, without
+       running the GRU again every epoch. The outputs are stored per token,
+       concatenated like the tokens of TokenizedMolData.
+
+        Args:
+                features : (n_tokens, hidden_size) array of GRU outputs, possibly memory-mapped
+                tokens : (n_tokens) array of the token indices
+                offsets : start offset of each molecule, plus the total length
+
+        Returns:
+                A Dataset returning ((seq_length, hidden_size) float32, (seq_length) int64) tensors
+    """
+    def __init__(self, features, tokens, offsets):
+        self.features = features
+        self.tokens = tokens
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, model, moldata, batch_size=128, path=None):
+        """
+        Runs every molecule of moldata through the GRU layers of model once
+        Args:
+            model: RNN whose GRU layers are frozen
+            moldata: MolData or TokenizedMolData to compute the outputs for
+            batch_size: number of molecules run through the GRU at a time
+            path: if given, the outputs are written to this .npy file and memory-mapped
+                  instead of being held in memory
+
+        Returns: FeatureCache
+
+        """
+        offsets = np.concatenate(([0], np.cumsum(moldata.lengths()))).astype(np.int64)
+        shape = (offsets[-1], model.rnn.linear.in_features)
+        if path:
+            features = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+        else:
+            features = np.empty(shape, dtype=np.float32)
+        tokens = np.empty(offsets[-1], dtype=np.int64)
+        with torch.no_grad():
+            for start in range(0, len(moldata), batch_size):
+                seqs = [moldata[i] for i in range(start, min(start + batch_size, len(moldata)))]
+                batch_features, _, _ = model.features(seqs)
+                batch_features = batch_features.cpu().numpy()
+                for j, seq in enumerate(seqs):
+                    begin, end = offsets[start + j], offsets[start + j + 1]
+                    features[begin:end] = batch_features[j, :len(seq)]
+                    tokens[begin:end] = seq.numpy()
+        if path:
+            features.flush()
+        return cls(features, tokens, offsets)
+
+    def __getitem__(self, i):
+        begin, end = self.offsets[i], self.offsets[i + 1]
+        return torch.from_numpy(np.asarray(self.features[begin:end])), torch.from_numpy(self.tokens[begin:end])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        """Returns the number of tokens of every sequence in the dataset"""
+        return np.diff(self.offsets)
+
+    @classmethod
+    def collate_fn(cls, arr):
+        """Pads a list of (features, tokens) pairs into a (features, tokens, lengths) batch"""
+        features = pad_sequence([item[0] for item in arr], batch_first=True)
+        tokens = pad_sequence([item[1] for item in arr], batch_first=True)
+        return features, tokens, torch.LongTensor([len(item[1]) for item in arr])
+
+
+def compile_mol_data(fname, voc, prefix):
+    """Tokenizes and encodes every SMILES in fname once and writes the token
+       indices to prefix.tok, with the start offset of each molecule (plus the
+       total length) in prefix.idx.npy. Read back with TokenizedMolData."""
+    offsets = [0]
+    with open(fname, 'r', encoding='utf-8-sig') as f, open(prefix + '.tok', 'wb') as out:
+        for line in f:
+            encoded = voc.encode(voc.tokenize(line.split()[0])).astype(TOKEN_DTYPE)
+            out.write(encoded.tobytes())
+            offsets.append(offsets[-1] + len(encoded))
+    np.save(prefix + '.idx.npy', np.array(offsets, dtype=np.int64))
+    return len(offsets) - 1
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler that groups sequences of similar length to reduce padding.
+       Every epoch the indices are shuffled and split into pools of
+       batch_size * pool_batches sequences. Each pool is sorted by length and
+       cut into batches, and the order of all batches is shuffled again.
+       For distributed training every replica builds the same batches from a
+       shared seed and keeps every num_replicas-th one, starting at rank.
+
+        Args:
+                lengths : number of tokens of every sequence in the dataset
+                batch_size : number of sequences per batch
+                pool_batches : number of batches sorted together in one pool
+                drop_last : drop the last incomplete batch of each pool
+                num_replicas : number of processes the batches are sharded over
+                rank : index of this process among the replicas
+                seed : seed for the shuffling, combined with the epoch set by
+                       set_epoch. Required when num_replicas > 1.
+    """
+    def __init__(self, lengths, batch_size, pool_batches=50, drop_last=False,
+                 num_replicas=1, rank=0, seed=None):
+        if num_replicas > 1 and seed is None:
+            raise ValueError("A shared seed is required to shard batches over several replicas")
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.pool_size = batch_size * pool_batches
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+        self.padded_tokens = 0
+        self.total_tokens = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        """Sets the epoch used together with the seed to shuffle the batches.
+           The first start_batch batches of the epoch are skipped, which lets a
+           seeded run resume in the middle of an epoch."""
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def __iter__(self):
+        if self.seed is None:
+            rng = np.random
+        else:
+            rng = np.random.RandomState(self.seed + self.epoch)
+        idx_arr = rng.permutation(len(self.lengths))
+        batches = []
+        for i in range(0, len(idx_arr), self.pool_size):
+            pool = idx_arr[i:i + self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            for j in range(0, len(pool), self.batch_size):
+                batch = pool[j:j + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        rng.shuffle(batches)
+        # Every replica has to take the same number of steps
+        batches = batches[self.rank:len(self) * self.num_replicas:self.num_replicas]
+        batches = batches[self.start_batch:]
+        self.padded_tokens = 0
+        self.total_tokens = 0
+        for batch in batches:
+            lengths = self.lengths[batch]
+            self.padded_tokens += int(lengths.max()) * len(batch)
+            self.total_tokens += int(lengths.sum())
+            yield batch.tolist()
+
+    def __len__(self):
+        n_batches = 0
+        for i in range(0, len(self.lengths), self.pool_size):
+            pool_len = min(self.pool_size, len(self.lengths) - i)
+            if self.drop_last:
+                n_batches += pool_len // self.batch_size
+            else:
+                n_batches += math.ceil(pool_len / self.batch_size)
+        return n_batches // self.num_replicas
+
+    def padding_ratio(self):
+        """Fraction of the tokens in the batches yielded so far this epoch that are padding"""
+        if self.padded_tokens == 0:
+            return 0.0
+        return 1 - self.total_tokens / self.padded_tokens
 
 
 def replace_halogen(string):
@@ -267,20 +470,26 @@ def batch_iter(data, batch_size=128, shuffle=True):
         yield i, examples
 
 
-def pad_seq(seqs):
-    batch_size = len(seqs)
-    seq_lengths = torch.LongTensor(list(map(len,seqs)))
-    max_length = len(seqs[0])
-    pad_seq = torch.zeros(batch_size, max_length,dtype=torch.long)
-    for i, seq in enumerate(seqs):
-        pad_seq[i, :len(seq)] = seq
-    return seq_lengths,pad_seq
+def pad_seq(seqs, eos=None):
+    """Takes a (batch_size * seq_length) tensor or a list of sequences and
+       returns their lengths and a zero padded long tensor. The rows of a
+       tensor end at their first END token if eos is given, as the padded
+       batches of RNN.sample and MolData.collate_fn do, and are full length
+       otherwise"""
+    if torch.is_tensor(seqs):
+        seq_lengths = torch.full((seqs.size(0),), seqs.size(1), dtype=torch.long, device=seqs.device)
+        if eos is not None:
+            is_eos = seqs == eos
+            seq_lengths = torch.where(is_eos.any(1), is_eos.int().argmax(1) + 1, seq_lengths)
+        return seq_lengths, seqs.long()
+    seq_lengths = torch.LongTensor([len(seq) for seq in seqs])
+    return seq_lengths, pad_sequence([seq.long() for seq in seqs], batch_first=True)
 
 def mask_seq(seqs, seq_lens):
-    mask = torch.zeros(seqs.size(0),seqs.size(1))
-    for i, length in enumerate(seq_lens):
-        mask[i, 0:length] = seqs[i, 0:length]
-    return mask
+    """Zeroes every entry of seqs past the length of its row"""
+    steps = torch.arange(seqs.size(1), device=seqs.device)
+    mask = steps.unsqueeze(0) < seq_lens.to(seqs.device).unsqueeze(1)
+    return seqs * mask
 
 if __name__ == "__main__":
     smiles_file = sys.argv[1]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+import argparse
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from rdkit import rdBase
+
+from data_structs import mask_seq
+from model import RNN
+from checkpoint import CheckpointWriter
+from sampling import compare_models, format_report
+from transfer_userinpt import load_model
+rdBase.DisableLog('rdApp.error')
+
+
+def distillation_loss(teacher, student, seqs, temperature=1.0):
+    """
+    Mean KL divergence per token from the next-token distributions of the
+    teacher to those of the student, on teacher-forced sequences
+    Args:
+        teacher: RNN to imitate
+        student: RNN being trained
+        seqs: sequences ending with the END token, as a list or as a batch padded after it
+        temperature: both distributions are softened by this temperature
+
+    Returns: loss, scaled by temperature ** 2 so its gradients do not depend on the temperature
+
+    """
+    with torch.no_grad():
+        features, seq_lens, _ = teacher.features(seqs)
+        teacher_log_prob = F.log_softmax(teacher.rnn.linear(features) / temperature, dim=2)
+    features, _, _ = student.features(seqs)
+    student_log_prob = F.log_softmax(student.rnn.linear(features) / temperature, dim=2)
+    kl = torch.sum(teacher_log_prob.exp() * (teacher_log_prob - student_log_prob), 2)
+    return temperature ** 2 * mask_seq(kl, seq_lens).sum() / seq_lens.sum().item()
+
+
+def distill(teacher, student_dir, num_layers=2, hidden_size=256, n_steps=5000, batch_size=128,
+            temperature=1.0, known=None, nums=1024):
+    """
+    Trains a smaller StackedGRU student to match the token distributions of a
+    trained prior or transfer model, on batches of molecules freshly sampled
+    from the teacher. When training is done, the student is compared with the
+    teacher by compare_models, and the checkpoint is tagged with the report:
+    it holds {'state_dict', 'num_layers', 'hidden_size', 'report'} and can be
+    passed to sample_smiles like any transfer model.
+    Args:
+        teacher: RNN to distill
+        student_dir: location to save the student
+        num_layers: number of GRU layers of the student
+        hidden_size: size of the GRU layers of the student
+        n_steps: number of optimizer steps
+        batch_size: number of teacher molecules per step
+        temperature: softening of the distributions in the loss
+        known: optional set of training SMILES, to report the novelty of both models
+        nums: number of molecules sampled by each model for the report
+
+    Returns: (student, report)
+
+    """
+    # Teacher and student both run as StackedGRU, for one-call teacher forcing and a fair speed comparison
+    fused_teacher = RNN(teacher.voc, fused=True)
+    fused_teacher.rnn.load_state_dict(teacher.rnn.state_dict())
+    teacher = fused_teacher
+    student = RNN(teacher.voc, fused=True, num_layers=num_layers, hidden_size=hidden_size)
+    optimizer = torch.optim.Adam(student.rnn.parameters(), lr=0.001)
+    checkpoint = CheckpointWriter(student_dir)
+
+    def tagged(report=None):
+        return {'state_dict': student.rnn.state_dict(), 'num_layers': num_layers,
+                'hidden_size': hidden_size, 'report': report}
+
+    for step in tqdm(range(n_steps)):
+        seqs = teacher.generate(batch_size)
+        loss = distillation_loss(teacher, student, seqs, temperature)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if (step + 1) % 500 == 0:
+            tqdm.write("Step {:5d}    KL: {:6.4f} per token".format(step + 1, loss.data.item()))
+            checkpoint.save(tagged())
+
+    report = compare_models(teacher, student, nums, known=known)
+    checkpoint.save(tagged(report))
+    checkpoint.close()
+    return student, report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill a prior or transfer model into a smaller student")
+    parser.add_argument('--voc', action='store', dest='voc_dir', default='data/Voc_danish',
+                        help='Directory for the vocabulary')
+    parser.add_argument('--teacher', action='store', dest='teacher_dir', default='data/Prior_local.ckpt',
+                        help='Directory of the model to distill')
+    parser.add_argument('--prior_model', action='store', dest='prior_dir', default='data/Prior_local.ckpt',
+                        help='Directory of the prior, if the teacher only holds adapters')
+    parser.add_argument('--student', action='store', dest='student_dir', default='data/student.ckpt',
+                        help='Directory to save the student')
+    parser.add_argument('--num_layers', action='store', dest='num_layers', default=2, type=int,
+                        help='Number of GRU layers of the student')
+    parser.add_argument('--hidden_size', action='store', dest='hidden_size', default=256, type=int,
+                        help='Size of the GRU layers of the student')
+    parser.add_argument('--steps', action='store', dest='n_steps', default=5000, type=int,
+                        help='Number of training steps')
+    parser.add_argument('--smi', action='store', dest='smi_dir', default=None,
+                        help='SMILES the teacher was trained on, to report novelty')
+    arg_dict = vars(parser.parse_args())
+    print(arg_dict)
+
+    teacher = load_model(arg_dict['voc_dir'], arg_dict['teacher_dir'], arg_dict['prior_dir'])
+    known = None
+    if arg_dict['smi_dir']:
+        with open(arg_dict['smi_dir'], 'r', encoding='utf-8-sig') as f:
+            known = set(line.split()[0] for line in f if line.strip())
+    _, report = distill(teacher, arg_dict['student_dir'], num_layers=arg_dict['num_layers'],
+                        hidden_size=arg_dict['hidden_size'], n_steps=arg_dict['n_steps'], known=known)
+    tqdm.write(format_report(report))
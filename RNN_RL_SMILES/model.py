@@ -1,56 +1,468 @@
 #!/usr/bin/env python
 
+import copy
+import json
+import time
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from typing import List, Optional, Tuple
 from data_structs import pad_seq, mask_seq
 from utils import Variable
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
  
 class MultiGRU(nn.Module):
     """ Implements a three layer GRU cell including an embedding layer
-       and an output linear layer back to the size of the vocabulary"""
-    def __init__(self, voc_size):
+       and an output linear layer back to the size of the vocabulary. The
+       layers are gru_1 ... gru_{num_layers}; smaller networks, such as
+       distilled students, can be built with num_layers and hidden_size."""
+    def __init__(self, voc_size, num_layers=3, hidden_size=512):
         super(MultiGRU, self).__init__()
         #self.voc_size = voc_size
         print("voc_size: ", voc_size)
+        self.num_layers = num_layers
+        self.hidden_size = hidden_size
         self.embedding = nn.Embedding(voc_size, 128)
-        self.gru_1 = nn.GRUCell(128, 512)
         #self.gru_1 = nn.GRU(128,512)
-        self.gru_2 = nn.GRUCell(512, 512)
-        self.gru_3 = nn.GRUCell(512, 512)
-        self.linear = nn.Linear(512, voc_size)
+        for i in range(num_layers):
+            setattr(self, 'gru_{}'.format(i + 1), nn.GRUCell(128 if i == 0 else hidden_size, hidden_size))
+        self.linear = nn.Linear(hidden_size, voc_size)
+
+    def layers(self):
+        """Returns the GRU cells from bottom to top"""
+        return [getattr(self, 'gru_{}'.format(i + 1)) for i in range(self.num_layers)]
 
     def forward(self, x, h):
         x = self.embedding(x)
         h_out = Variable(torch.zeros(h.size()))
-        x = h_out[0] = self.gru_1(x, h[0])
-        x = h_out[1] = self.gru_2(x, h[1])
-        x = h_out[2] = self.gru_3(x, h[2])
+        for i, gru in enumerate(self.layers()):
+            x = h_out[i] = gru(x, h[i])
+        x = self.linear(x)
+        return x, h_out
+
+    def init_h(self, batch_size):
+        # Initial cell state is zero
+        return Variable(torch.zeros(self.num_layers, batch_size, self.hidden_size))
+
+    def load_state_dict(self, state_dict, strict=True):
+        """Loads a checkpoint saved from either MultiGRU or StackedGRU"""
+        return super(MultiGRU, self).load_state_dict(cell_state_dict(state_dict), strict)
+
+class StackedGRU(nn.Module):
+    """ Same network as MultiGRU, but the three GRU layers are held in a single
+        stacked nn.GRU so that a whole teacher-forced sequence can be run in one
+        call instead of one GRUCell step per token. Checkpoints of both layouts
+        can be loaded into either class. Smaller networks, such as distilled
+        students, can be built with num_layers and hidden_size."""
+    def __init__(self, voc_size, num_layers=3, hidden_size=512):
+        super(StackedGRU, self).__init__()
+        self.num_layers = num_layers
+        self.hidden_size = hidden_size
+        self.embedding = nn.Embedding(voc_size, 128)
+        self.gru = nn.GRU(128, hidden_size, num_layers=num_layers, batch_first=True)
+        self.linear = nn.Linear(hidden_size, voc_size)
+
+    def forward(self, x, h):
+        x = self.embedding(x).unsqueeze(1)
+        x, h_out = self.gru(x, h)
+        x = self.linear(x.squeeze(1))
+        return x, h_out
+
+    def forward_sequence(self, x, h):
+        """
+            Runs a full (batch_size * seq_length) batch of input tokens through
+            the network and returns the logits for every step.
+        """
+        x, h_out = self.features(x, h)
         x = self.linear(x)
         return x, h_out
 
+    def features(self, x, h):
+        """Same as forward_sequence, but returns the outputs of the top GRU
+           layer, before the linear layer."""
+        x = self.embedding(x)
+        return self.gru(x, h)
+
     def init_h(self, batch_size):
         # Initial cell state is zero
-        return Variable(torch.zeros(3, batch_size, 512))
+        return Variable(torch.zeros(self.num_layers, batch_size, self.hidden_size))
+
+    def load_state_dict(self, state_dict, strict=True):
+        """Loads a checkpoint saved from either MultiGRU or StackedGRU"""
+        return super(StackedGRU, self).load_state_dict(stacked_state_dict(state_dict), strict)
+
+def stacked_state_dict(state_dict):
+    """Maps the gru_1/gru_2/... keys of a MultiGRU checkpoint onto the
+       per-layer keys of the stacked nn.GRU in StackedGRU."""
+    mapped = state_dict.__class__()
+    for key, value in state_dict.items():
+        name = key.split('.')
+        if name[0].startswith('gru_') and name[0][4:].isdigit():
+            key = 'gru.{}_l{}'.format(name[1], int(name[0][4:]) - 1)
+        mapped[key] = value
+    return mapped
+
+def cell_state_dict(state_dict):
+    """Inverse of stacked_state_dict, maps a StackedGRU checkpoint back onto
+       the gru_1/gru_2/... GRUCells of MultiGRU."""
+    mapped = state_dict.__class__()
+    for key, value in state_dict.items():
+        name = key.split('.')
+        if name[0] == 'gru':
+            param, layer = name[1].rsplit('_l', 1)
+            key = 'gru_{}.{}'.format(int(layer) + 1, param)
+        mapped[key] = value
+    return mapped
+
+def network_size(state_dict):
+    """Returns (num_layers, hidden_size) of a checkpoint of either layout"""
+    state_dict = cell_state_dict(state_dict)
+    num_layers = 0
+    while 'gru_{}.weight_hh'.format(num_layers + 1) in state_dict:
+        num_layers += 1
+    return num_layers, state_dict['gru_1.weight_hh'].size(1)
+
+class OnnxStep(nn.Module):
+    """One step of the network with the hidden state as a single
+       (num_layers, batch_size, hidden_size) tensor and no in-place writes,
+       for export to ONNX by RNN.export_onnx."""
+    def __init__(self, rnn):
+        super(OnnxStep, self).__init__()
+        self.rnn = MultiGRU(rnn.linear.out_features, rnn.num_layers, rnn.hidden_size)
+        self.rnn.load_state_dict({key: value.cpu() for key, value in rnn.state_dict().items()})
+
+    def forward(self, x, h):
+        x = self.rnn.embedding(x)
+        h_out = []
+        for i, gru in enumerate(self.rnn.layers()):
+            x = gru(x, h[i])
+            h_out.append(x)
+        return self.rnn.linear(x), torch.stack(h_out)
+
+class CompiledGRU(nn.Module):
+    """TorchScript kernels for the decode loop of RNN.sample and the per-token
+       loop of RNN.likelihood: embedding, the GRU layers, projection,
+       sampling and log-prob accumulation all run in the TorchScript
+       interpreter instead of Python. The module holds the same parameter
+       tensors as the MultiGRU or StackedGRU it is built from, so it follows
+       their training and loading. Build it with torch.jit.script."""
+    def __init__(self, rnn):
+        super(CompiledGRU, self).__init__()
+        state = cell_state_dict(dict(rnn.named_parameters()))
+        self.embedding_weight = state['embedding.weight']
+        self.linear_weight = state['linear.weight']
+        self.linear_bias = state['linear.bias']
+        layers = range(1, rnn.num_layers + 1)
+        self.num_layers = rnn.num_layers
+        self.weights_ih = nn.ParameterList([state['gru_{}.weight_ih'.format(i)] for i in layers])
+        self.weights_hh = nn.ParameterList([state['gru_{}.weight_hh'.format(i)] for i in layers])
+        self.biases_ih = nn.ParameterList([state['gru_{}.bias_ih'.format(i)] for i in layers])
+        self.biases_hh = nn.ParameterList([state['gru_{}.bias_hh'.format(i)] for i in layers])
+
+    def step(self, x: torch.Tensor, h: List[torch.Tensor]) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        x = F.embedding(x, self.embedding_weight)
+        h_out: List[torch.Tensor] = []
+        i = 0
+        for w_ih, w_hh, b_ih, b_hh in zip(self.weights_ih, self.weights_hh, self.biases_ih, self.biases_hh):
+            x = torch.gru_cell(x, h[i], w_ih, w_hh, b_ih, b_hh)
+            h_out.append(x)
+            i += 1
+        return F.linear(x, self.linear_weight, self.linear_bias), h_out
+
+    def init_h(self, batch_size: int) -> List[torch.Tensor]:
+        return [torch.zeros(batch_size, self.weights_hh[0].size(1), device=self.linear_weight.device)
+                for _ in range(self.num_layers)]
+
+    @torch.jit.export
+    def sample(self, batch_size: int, max_length: int, go: int, eos: int, likelihood: bool,
+               entropy: bool) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor]]:
+        device = self.linear_weight.device
+        h = self.init_h(batch_size)
+        x = torch.full([batch_size], go, dtype=torch.long, device=device)
+        sequences = torch.full([batch_size, max_length], eos, dtype=torch.long, device=device)
+        log_probs = torch.zeros(batch_size, device=device)
+        entropies = torch.zeros(batch_size, device=device)
+        active = torch.arange(batch_size, device=device)
+
+        step = 0
+        for step in range(max_length):
+            logits, h = self.step(x, h)
+            prob = F.softmax(logits, dim=1)
+            x = torch.multinomial(prob, 1).view(-1)
+            sequences[active, step] = x
+            if likelihood or entropy:
+                log_prob = F.log_softmax(logits, dim=1)
+                if likelihood:
+                    log_probs = log_probs.index_add(0, active, log_prob.gather(1, x.unsqueeze(1)).squeeze(1))
+                if entropy:
+                    entropies = entropies.index_add(0, active, -torch.sum(log_prob * prob, 1))
+
+            unfinished = (x != eos).nonzero().view(-1)
+            if unfinished.size(0) == 0:
+                break
+            if unfinished.size(0) < active.size(0):
+                active = active[unfinished]
+                x = x[unfinished]
+                h = [h_layer[unfinished] for h_layer in h]
+
+        return (sequences[:, :step + 1], log_probs if likelihood else None,
+                entropies if entropy else None)
+
+    @torch.jit.export
+    def likelihood(self, x: torch.Tensor, target: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch_size, seq_length = target.size()
+        h = self.init_h(batch_size)
+        log_losses: List[torch.Tensor] = []
+        entropy = torch.zeros(batch_size, device=target.device)
+        for step in range(seq_length):
+            logits, h = self.step(x[:, step], h)
+            log_prob = F.log_softmax(logits, dim=1)
+            log_losses.append(log_prob.gather(1, target[:, step].unsqueeze(1)).squeeze(1))
+            entropy = entropy - torch.sum(log_prob * F.softmax(logits, dim=1), 1)
+        return torch.stack(log_losses, 1), entropy
+
+class SpeculativeSampler():
+    """Speculative sampling from a model with the help of a cheaper draft
+       model. For every unfinished row the draft proposes k tokens, the model
+       scores all of them in one teacher-forced pass, and each proposal is
+       accepted with probability min(1, p / q). At the first rejection a token
+       is drawn from the normalized max(0, p - q) instead, and when all k are
+       accepted one more token is drawn from the model, so the sequences
+       follow exactly the distribution of the model. The teacher-forced pass
+       runs each GRU layer as a single-layer nn.GRU sharing the weights of the
+       model, which gives the hidden states after every token to restart from.
+
+        Args:
+                model : RNN to sample from, either layout
+                draft : RNN proposing the tokens, e.g. a distilled student or a quantized copy
+                k : number of tokens proposed per pass
+    """
+    def __init__(self, model, draft, k=4):
+        self.model = model
+        self.draft = draft
+        self.k = k
+        params = cell_state_dict(dict(model.rnn.named_parameters()))
+        self.layers = []
+        i = 1
+        while 'gru_{}.weight_ih'.format(i) in params:
+            weight_ih = params['gru_{}.weight_ih'.format(i)]
+            layer = nn.GRU(weight_ih.size(1), weight_ih.size(0) // 3, batch_first=True)
+            for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh'):
+                setattr(layer, name + '_l0', params['gru_{}.{}'.format(i, name)])
+            self.layers.append(layer)
+            i += 1
+        self.proposed = 0
+        self.accepted = 0
+        self.tokens = 0
+        self.time = 0.0
+
+    def _score(self, x, h):
+        """Teacher-forced pass over x (batch_size, seq_length), returns the
+           logits and the hidden states (num_layers, batch_size, seq_length, hidden_size)
+           after every token"""
+        out = self.model.rnn.embedding(x)
+        states = []
+        for layer, h_layer in zip(self.layers, h):
+            out, _ = layer(out, h_layer.unsqueeze(0).contiguous())
+            states.append(out)
+        return self.model.rnn.linear(out), torch.stack(states)
+
+    def sample(self, batch_size, max_length=140):
+        """
+            Sample a batch of sequences
+
+            Args:
+                batch_size : Number of sequences to sample
+                max_length:  Maximum length of the sequences
+
+            Outputs:
+            seqs: (batch_size, seq_length) The sampled sequences, padded with
+                                           the END token after it is sampled.
+            log_probs : (batch_size) Log likelihood of each sequence under the model
+        """
+        start = time.time()
+        eos = self.model.voc.vocab['EOS']
+        k = self.k
+        with torch.no_grad():
+            sequences = Variable(torch.zeros(batch_size, max_length).long())
+            sequences[:] = eos
+            log_probs = Variable(torch.zeros(batch_size))
+            lengths = Variable(torch.zeros(batch_size).long())
+            active = Variable(torch.arange(batch_size))
+            x = Variable(torch.zeros(batch_size).long())
+            x[:] = self.model.voc.vocab['GO']
+            h = self.model.rnn.init_h(batch_size)
+            h_draft = self.draft.rnn.init_h(batch_size)
+            steps = Variable(torch.arange(k + 1))
+
+            while active.size(0):
+                n_active = active.size(0)
+                rows = Variable(torch.arange(n_active))
+                # Draft k tokens, keeping the draft state after each one
+                drafts, draft_probs, draft_states = [], [], []
+                x_draft = x
+                for _ in range(k):
+                    logits, h_draft = self.draft.rnn(x_draft, h_draft)
+                    draft_states.append(h_draft)
+                    prob = F.softmax(logits, dim=1)
+                    x_draft = torch.multinomial(prob, 1).view(-1)
+                    drafts.append(x_draft)
+                    draft_probs.append(prob)
+                _, h_draft = self.draft.rnn(x_draft, h_draft)
+                draft_states.append(h_draft)
+                drafts = torch.stack(drafts, 1)
+                draft_probs = torch.stack(draft_probs, 1)
+
+                # Score the pending token and the k drafts with the model in one pass
+                logits, states = self._score(torch.cat((x.unsqueeze(1), drafts), 1), h)
+                prob = F.softmax(logits, dim=2)
+                p = prob[:, :k].gather(2, drafts.unsqueeze(2)).squeeze(2)
+                q = draft_probs.gather(2, drafts.unsqueeze(2)).squeeze(2)
+                accept = Variable(torch.rand(n_active, k)) * q < p
+                n_accepted = torch.cumprod(accept.long(), 1).sum(1)
+
+                # Correct the first rejected token, or add one from the model if all were accepted
+                draft_probs = torch.cat((draft_probs, torch.zeros_like(draft_probs[:, :1])), 1)
+                residual = torch.clamp(prob[rows, n_accepted] - draft_probs[rows, n_accepted], min=0)
+                empty = residual.sum(1, keepdim=True) <= 0
+                residual = torch.where(empty, prob[rows, n_accepted], residual)
+                last = torch.multinomial(residual, 1).view(-1)
+                tokens = torch.cat((drafts, torch.zeros_like(drafts[:, :1])), 1)
+                tokens[rows, n_accepted] = last
+
+                # Write the accepted tokens up to the first END token
+                keep = steps.unsqueeze(0) <= n_accepted.unsqueeze(1)
+                is_eos = (tokens == eos) & keep
+                keep = keep & (torch.cumsum(is_eos.long(), 1) - is_eos.long() == 0)
+                positions = lengths[active].unsqueeze(1) + steps.unsqueeze(0)
+                keep = keep & (positions < max_length)
+                sequences[active.unsqueeze(1).expand_as(tokens)[keep], positions[keep]] = tokens[keep]
+                token_log_probs = F.log_softmax(logits, dim=2).gather(2, tokens.unsqueeze(2)).squeeze(2)
+                log_probs = log_probs.index_add(0, active, (token_log_probs * keep).sum(1))
+                lengths[active] += keep.sum(1)
+
+                self.proposed += n_active * k
+                self.accepted += n_accepted.sum().item()
+                self.tokens += keep.sum().item()
+
+                # Restart both models after the last accepted draft token
+                h = states[:, rows, n_accepted]
+                h_draft = torch.stack(draft_states)[n_accepted, :, rows].transpose(0, 1)
+                unfinished = (~(is_eos.any(1) | (lengths[active] >= max_length))).nonzero().view(-1)
+                active = active[unfinished]
+                x = last[unfinished]
+                h = h[:, unfinished].contiguous()
+                h_draft = h_draft[:, unfinished].contiguous()
+
+        self.time += time.time() - start
+        return sequences[:, :int(lengths.max())], log_probs
+
+    def acceptance_rate(self):
+        """Fraction of the drafted tokens accepted so far"""
+        return self.accepted / max(self.proposed, 1)
+
+    def tokens_per_second(self):
+        """Tokens sampled per second so far"""
+        return self.tokens / max(self.time, 1e-9)
 
 class RNN():
     """Implements the Prior and Agent RNN. Needs a Vocabulary instance in
-    order to determine size of the vocabulary and index of the END token"""
-    def __init__(self, voc):
-        self.rnn = MultiGRU(voc.vocab_size)
+    order to determine size of the vocabulary and index of the END token.
+    With fused=True the network is a StackedGRU and likelihood() runs the
+    whole batch through the stacked GRU in one call. With compiled=True,
+    sample() and the per-token loop of likelihood() run as TorchScript
+    kernels (see CompiledGRU). After use_onnx(), sample() runs an ONNX
+    export of the network with ONNX Runtime. num_layers and hidden_size
+    set the size of the network.
+    with_draft() returns a copy that samples speculatively with a draft model."""
+    def __init__(self, voc, fused=False, compiled=False, num_layers=3, hidden_size=512):
+        if fused:
+            self.rnn = StackedGRU(voc.vocab_size, num_layers, hidden_size)
+        else:
+            self.rnn = MultiGRU(voc.vocab_size, num_layers, hidden_size)
         self.voc_size = voc.vocab_size
         if torch.cuda.is_available():
             self.rnn.cuda()
         self.voc = voc
+        self.compiled = torch.jit.script(CompiledGRU(self.rnn)) if compiled else None
+        self.onnx = None
+        self.speculative = None
+
+    def _copy(self):
+        """Shallow copy without the TorchScript kernels, ONNX session and draft
+           model, which are bound to the network of this RNN"""
+        rnn_copy = copy.copy(self)
+        rnn_copy.compiled = None
+        rnn_copy.onnx = None
+        rnn_copy.speculative = None
+        return rnn_copy
 
-    def likelihood(self, target):
+    def shared_copy(self):
+        """Returns a new RNN whose network holds the same parameter tensors as
+           this one, so several models can be built on one copy of the prior
+           weights. Layers replaced or adapted on the copy stay its own."""
+        shared = self._copy()
+        shared.rnn = copy.deepcopy(self.rnn, {id(param): param for param in self.rnn.parameters()})
+        return shared
+
+    def quantized(self):
+        """Returns a copy of the RNN for CPU sampling, where the GRU cells and
+           the linear layer of a MultiGRU use dynamically quantized int8
+           weights. Faster than the float model, at the cost of a small drift
+           in the likelihoods; compare them with sampling.compare_models.
+           Quantized kernels only run on the CPU, while the inputs of sample()
+           and likelihood() are put on the GPU whenever one is available, so
+           this raises a RuntimeError on CUDA hosts."""
+        if torch.cuda.is_available():
+            raise RuntimeError("The int8 quantized model only runs on the CPU, but CUDA is available; "
+                               "sample from the float model on the GPU instead")
+        rnn = MultiGRU(self.voc_size, self.rnn.num_layers, self.rnn.hidden_size)
+        rnn.load_state_dict({key: value.cpu() for key, value in self.rnn.state_dict().items()})
+        quantized = self._copy()
+        quantized.rnn = torch.ao.quantization.quantize_dynamic(rnn, {nn.GRUCell, nn.Linear}, dtype=torch.qint8)
+        return quantized
+
+    def export_onnx(self, path, opset_version=17):
+        """Exports a single step of the network to path as an ONNX graph, with
+           inputs token (batch_size) and h (num_layers, batch_size, hidden_size) and outputs
+           logits and h_out. The vocabulary is written to path + '.json', for
+           sampling with ort_sampling.OnnxSampler."""
+        step = OnnxStep(self.rnn).eval()
+        x = torch.zeros(2, dtype=torch.long)
+        h = torch.zeros(self.rnn.num_layers, 2, self.rnn.hidden_size)
+        torch.onnx.export(step, (x, h), path, input_names=['token', 'h'], output_names=['logits', 'h_out'],
+                          dynamic_axes={'token': {0: 'batch'}, 'h': {1: 'batch'},
+                                        'logits': {0: 'batch'}, 'h_out': {1: 'batch'}},
+                          opset_version=opset_version, dynamo=False)
+        meta = {'chars': [self.voc.reversed_vocab[i] for i in range(self.voc_size)],
+                'go': self.voc.vocab['GO'], 'eos': self.voc.vocab['EOS'],
+                'num_layers': self.rnn.num_layers, 'hidden_size': self.rnn.hidden_size}
+        with open(path + '.json', 'w') as f:
+            json.dump(meta, f)
+
+    def use_onnx(self, path, seed=None):
+        """Makes sample() run the ONNX export at path with ONNX Runtime instead of the torch network"""
+        from ort_sampling import OnnxSampler
+        self.onnx = OnnxSampler(path, seed=seed)
+
+    def with_draft(self, draft, k=4):
+        """Returns a copy of the RNN whose sample() uses speculative sampling
+           with the draft model (see SpeculativeSampler). Its sequences follow
+           the same distribution, and the acceptance rate and tokens per
+           second are kept on its speculative attribute."""
+        speculative = self._copy()
+        speculative.speculative = SpeculativeSampler(self, draft, k)
+        return speculative
+
+    def likelihood(self, target, seq_lens=None):
         """
             Retrieves the likelihood of a given sequence
 
             Args:
                 target: (batch_size * sequence_lenghth) A batch of sequences
+                seq_lens: (batch_size) Length of each sequence, as returned by
+                          MolData.collate_fn. Taken from target if None.
 
             Outputs:
                 log_probs : (batch_size) Log likelihood for each example*
@@ -64,7 +476,9 @@ class RNN():
         #    collated_arr[i, :seq.size(0)] = seq
         #return collated_arr
         # print("target in likelihood", target)
-        seq_lens, target = pad_seq(target)
+        padded_lens, target = pad_seq(target, self.voc.vocab['EOS'])
+        if seq_lens is None:
+            seq_lens = padded_lens
         # print("seq_lens", seq_lens)
         target = Variable(target)
         # print("target", target)
@@ -80,6 +494,19 @@ class RNN():
         # print("x", x)
         h = self.rnn.init_h(batch_size)
 
+        if isinstance(self.rnn, StackedGRU):
+            logits, h = self.rnn.forward_sequence(x, h)
+            log_prob = F.log_softmax(logits, dim=2)
+            prob = F.softmax(logits, dim=2)
+            log_losses = torch.gather(log_prob, 2, target.unsqueeze(2)).squeeze(2)
+            entropy = -torch.sum(log_prob * prob, 2).sum(1)
+            log_losses = mask_seq(log_losses, seq_lens)
+            return torch.sum(log_losses, 1), entropy
+
+        if self.compiled is not None:
+            log_losses, entropy = self.compiled.likelihood(x, target)
+            return torch.sum(mask_seq(log_losses, seq_lens), 1), entropy
+
         log_probs = Variable(torch.zeros(batch_size))
         log_losses = Variable(torch.zeros(batch_size,seq_length))
         entropy = Variable(torch.zeros(batch_size))
@@ -95,50 +522,196 @@ class RNN():
         log_all = torch.sum(log_losses, 1)
         return log_all, entropy
 
-    def sample(self, batch_size, max_length=140):
+    def features(self, target):
         """
-            Sample a batch of sequences
+            Runs a batch of sequences through the embedding and GRU layers only.
+
+            Args:
+                target: (batch_size * sequence_length) A batch of sequences
+
+            Outputs:
+                features : (batch_size, sequence_length, hidden_size) Outputs of the
+                           top GRU layer, the input of the linear layer
+                seq_lens : (batch_size) Length of each sequence
+                target : (batch_size, sequence_length) The padded sequences
+        """
+        seq_lens, target = pad_seq(target, self.voc.vocab['EOS'])
+        target = Variable(target)
+        batch_size, seq_length = target.size()
+        start_token = Variable(torch.zeros(batch_size, 1).long())
+        start_token[:] = self.voc.vocab['GO']
+        x = torch.cat((start_token, target[:, :-1]), 1)
+        h = self.rnn.init_h(batch_size)
+
+        if isinstance(self.rnn, StackedGRU):
+            features, _ = self.rnn.features(x, h)
+            return features, seq_lens, target
+
+        x = self.rnn.embedding(x)
+        h = list(h)
+        features = []
+        for step in range(seq_length):
+            out = x[:, step]
+            for i, gru in enumerate(self.rnn.layers()):
+                out = h[i] = gru(out, h[i])
+            features.append(out)
+        return torch.stack(features, 1), seq_lens, target
+
+    def head_likelihood(self, features, target, seq_lens):
+        """
+            Log likelihood of sequences from precomputed top-layer GRU outputs,
+            so that only the linear layer is run.
+
+            Args:
+                features : (batch_size, sequence_length, hidden_size) As returned by features()
+                target : (batch_size, sequence_length) The padded sequences
+                seq_lens : (batch_size) Length of each sequence
+
+            Outputs:
+                log_probs : (batch_size) Log likelihood for each example
+        """
+        log_prob = F.log_softmax(self.rnn.linear(Variable(features)), dim=2)
+        log_losses = torch.gather(log_prob, 2, Variable(target).long().unsqueeze(2)).squeeze(2)
+        return torch.sum(mask_seq(log_losses, seq_lens), 1)
+
+    def sample(self, batch_size, max_length=140, likelihood=True, entropy=True):
+        """
+            Sample a batch of sequences. Rows that have sampled the END token
+            are dropped from the active batch, so only unfinished sequences are
+            fed through the network at each step.
 
             Args:
                 batch_size : Number of sequences to sample 
                 max_length:  Maximum length of the sequences
+                likelihood: If False, log_probs are not accumulated
+                entropy: If False, the entropies are not accumulated
+
+            Outputs:
+            seqs: (batch_size, seq_length) The sampled sequences, padded with
+                                           the END token after it is sampled.
+            log_probs : (batch_size) Log likelihood for each sequence, None
+                                     if likelihood is False.
+            entropy: (batch_size) The entropies for the sequences, None if
+                                  entropy is False. Not currently used.
+        """
+        if self.speculative is not None:
+            seqs, log_probs = self.speculative.sample(batch_size, max_length)
+            return seqs, log_probs if likelihood else None, None
+        if self.onnx is not None:
+            seqs, log_probs, entropies = self.onnx.sample(batch_size, max_length)
+            return (Variable(torch.from_numpy(seqs)), Variable(torch.from_numpy(log_probs)) if likelihood else None,
+                    Variable(torch.from_numpy(entropies)) if entropy else None)
+        if self.compiled is not None:
+            return self.compiled.sample(batch_size, max_length, self.voc.vocab['GO'], self.voc.vocab['EOS'],
+                                        likelihood, entropy)
+
+        start_token = Variable(torch.zeros(batch_size).long())
+        start_token[:] = self.voc.vocab['GO']
+        h = self.rnn.init_h(batch_size)
+        x = start_token
+
+        sequences = Variable(torch.zeros(batch_size, max_length).long())
+        sequences[:] = self.voc.vocab['EOS']
+        log_probs = Variable(torch.zeros(batch_size)) if likelihood else None
+        entropies = Variable(torch.zeros(batch_size)) if entropy else None
+        # Batch indices of the rows that have not sampled EOS yet
+        active = Variable(torch.arange(batch_size))
+
+        for step in range(max_length):
+
+            logits, h = self.rnn(x, h)
+            prob = F.softmax(logits, dim=1)
+            x = torch.multinomial(prob, 1).view(-1)
+            sequences[active, step] = x
+            if likelihood or entropy:
+                log_prob = F.log_softmax(logits, dim=1)
+            if likelihood:
+                log_probs = log_probs.index_add(0, active, NLLLoss(log_prob, x))
+            if entropy:
+                entropies = entropies.index_add(0, active, -torch.sum((log_prob * prob), 1))
+
+            unfinished = (x != self.voc.vocab['EOS']).nonzero().view(-1)
+            if unfinished.size(0) == 0: break
+            if unfinished.size(0) < active.size(0):
+                active = active[unfinished]
+                x = x[unfinished]
+                h = h[:, unfinished]
+
+        return sequences[:, :step + 1], log_probs, entropies
+
+    def generate(self, batch_size, max_length=140):
+        """
+            Inference-only sampling. Runs under torch.inference_mode, so no
+            autograd graph is kept, and skips the likelihood and entropy
+            bookkeeping.
+
+            Args:
+                batch_size : Number of sequences to sample
+                max_length:  Maximum length of the sequences
 
             Outputs:
             seqs: (batch_size, seq_length) The sampled sequences.
-            log_probs : (batch_size) Log likelihood for each sequence.
-            entropy: (batch_size) The entropies for the sequences. Not
-                                    currently used.
         """
-        start_token_init = Variable(torch.zeros(batch_size).long())
-        start_token = start_token_init.clone()
+        with torch.inference_mode():
+            seqs, _, _ = self.sample(batch_size, max_length, likelihood=False, entropy=False)
+        return seqs
+
+    def sample_with_prior(self, prior, batch_size, max_length=140):
+        """
+            Samples like sample() and steps prior through the same tokens in
+            lockstep, so the log likelihood of the sequences under the prior
+            comes without a second, teacher-forced pass. The prior is run
+            without gradients; rows that have sampled the END token are dropped
+            from both models.
+
+            Args:
+                prior : RNN scoring the sampled sequences, e.g. the Prior of reinforcement learning
+                batch_size : Number of sequences to sample
+                max_length:  Maximum length of the sequences
+
+            Outputs:
+            seqs: (batch_size, seq_length) The sampled sequences, padded with
+                                           the END token after it is sampled.
+            log_probs : (batch_size) Log likelihood for each sequence
+            entropy: (batch_size) The entropies for the sequences
+            prior_log_probs : (batch_size) Log likelihood for each sequence under the prior
+        """
+        start_token = Variable(torch.zeros(batch_size).long())
         start_token[:] = self.voc.vocab['GO']
         h = self.rnn.init_h(batch_size)
+        prior_h = prior.rnn.init_h(batch_size)
         x = start_token
 
-        sequences = []
+        sequences = Variable(torch.zeros(batch_size, max_length).long())
+        sequences[:] = self.voc.vocab['EOS']
         log_probs = Variable(torch.zeros(batch_size))
-        finished = torch.zeros(batch_size).byte()
-        entropy = Variable(torch.zeros(batch_size))
-        if torch.cuda.is_available():
-            finished = finished.cuda()
+        entropies = Variable(torch.zeros(batch_size))
+        prior_log_probs = Variable(torch.zeros(batch_size))
+        active = Variable(torch.arange(batch_size))
 
         for step in range(max_length):
-            
+
             logits, h = self.rnn(x, h)
+            with torch.no_grad():
+                prior_logits, prior_h = prior.rnn(x, prior_h)
             prob = F.softmax(logits, dim=1)
             log_prob = F.log_softmax(logits, dim=1)
-            x = torch.multinomial(prob,1).view(-1)
-            sequences.append(x.view(-1, 1))
-            log_probs +=  NLLLoss(log_prob, x)
-            entropy += -torch.sum((log_prob * prob), 1)
+            x = torch.multinomial(prob, 1).view(-1)
+            sequences[active, step] = x
+            log_probs = log_probs.index_add(0, active, NLLLoss(log_prob, x))
+            entropies = entropies.index_add(0, active, -torch.sum((log_prob * prob), 1))
+            with torch.no_grad():
+                prior_log_probs.index_add_(0, active, NLLLoss(F.log_softmax(prior_logits, dim=1), x))
 
-            x = Variable(x.data)
-            EOS_sampled = (x == self.voc.vocab['EOS']).data
-            finished = torch.ge(finished + EOS_sampled, 1)
-            if torch.prod(finished) == 1: break
+            unfinished = (x != self.voc.vocab['EOS']).nonzero().view(-1)
+            if unfinished.size(0) == 0: break
+            if unfinished.size(0) < active.size(0):
+                active = active[unfinished]
+                x = x[unfinished]
+                h = h[:, unfinished]
+                prior_h = prior_h[:, unfinished]
 
-        sequences = torch.cat(sequences, 1)
-        return sequences.data, log_probs, entropy
+        return sequences[:, :step + 1], log_probs, entropies, prior_log_probs
 
 def NLLLoss(inputs, targets):
     """
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+import os
+import torch
+import torch.multiprocessing as mp
+import pandas as pd
+from rdkit import rdBase
+
+from adapters import dense_state_dict
+from checkpoint import snapshot_state
+from model import RNN, network_size
+from sampling import is_valid_smiles
+
+
+def _monitor_worker(voc, default_csv_path, jobs, done):
+    """Worker process for ValidityMonitor, samples from every weight snapshot it receives"""
+    rdBase.DisableLog('rdApp.error')
+    # Leave the CPU cores to the training process
+    torch.set_num_threads(1)
+    model = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        state_dict, n, epoch, step, record, job_csv_path = job
+        csv_path = job_csv_path or default_csv_path
+        # Built on the first snapshot, and again if a snapshot has a different size
+        num_layers, hidden_size = network_size(state_dict)
+        if model is None or (model.rnn.num_layers, model.rnn.hidden_size) != (num_layers, hidden_size):
+            model = RNN(voc, num_layers=num_layers, hidden_size=hidden_size)
+            for param in model.rnn.parameters():
+                param.requires_grad = False
+        model.rnn.load_state_dict(state_dict)
+        smiles = [voc.decode(seq) for seq in model.generate(n).cpu().numpy()]
+        valid_smiles = [smile for smile in smiles if is_valid_smiles(smile)]
+
+        lines = ['*' * 50, "Validity check at epoch {:3d}   step {:3d}{}\n".format(
+            epoch, step, '   ' + csv_path if csv_path else '')]
+        lines += smiles[:5]
+        lines += ["\n{:>4.1f}% valid SMILES".format(100 * len(valid_smiles) / n), '*' * 50 + '\n']
+        print('\n'.join(lines), flush=True)
+
+        if record and csv_path:
+            header = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+            start = 0 if header else len(pd.read_csv(csv_path, index_col=0))
+            df = pd.DataFrame({'SMILES': valid_smiles, 'Epoch': epoch},
+                              index=range(start, start + len(valid_smiles)), columns=['SMILES', 'Epoch'])
+            df.to_csv(csv_path, mode='a', header=header)
+        with done.get_lock():
+            done.value += 1
+
+
+class ValidityMonitor():
+    """Samples from snapshots of the model weights and checks the validity of
+       the SMILES with RDKit in a separate process, so that training carries
+       on while the molecules are sampled and parsed. The process is started
+       with spawn, since forking a process that runs DataLoader and checkpoint
+       threads is not safe.
+
+       Periodic checks are skipped while max_pending snapshots are still
+       waiting to be sampled; recorded checks are always queued. The valid
+       SMILES of recorded checks are appended to csv_path with their epoch.
+
+        Args:
+                voc : Vocabulary of the model
+                csv_path : CSV file the recorded SMILES are appended to, or None
+                append : if False, an existing csv_path is replaced
+                max_pending : number of queued snapshots above which periodic checks are skipped
+    """
+    def __init__(self, voc, csv_path=None, append=False, max_pending=1):
+        if csv_path and not append and os.path.exists(csv_path):
+            os.remove(csv_path)
+        self.max_pending = max_pending
+        ctx = mp.get_context('spawn')
+        self._jobs = ctx.Queue()
+        self._done = ctx.Value('i', 0)
+        self._submitted = 0
+        self._process = ctx.Process(target=_monitor_worker, args=(voc, csv_path, self._jobs, self._done),
+                                    daemon=True)
+        self._process.start()
+
+    def check(self, model, n, epoch, step, record=False, csv_path=None):
+        """
+        Queues a validity check of n molecules sampled from the current weights
+        Args:
+            model: nn.Module whose weights are sampled from, either layout of the RNN, with or without adapters
+            n: number of molecules to sample
+            epoch, step: where in training the snapshot was taken, for the log and the CSV
+            record: if True, the valid SMILES are appended to the CSV and the check is never skipped
+            csv_path: CSV file to append to instead of the one of the monitor, for monitoring several models
+
+        Returns: True if the check was queued
+
+        """
+        self._raise_error()
+        if not record and self._submitted - self._done.value >= self.max_pending:
+            return False
+        self._jobs.put((snapshot_state(dense_state_dict(model)), n, epoch, step, record, csv_path))
+        self._submitted += 1
+        return True
+
+    def close(self):
+        """Waits for the queued checks to finish and stops the monitor process"""
+        self._jobs.put(None)
+        self._process.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._process.exitcode not in (None, 0):
+            raise RuntimeError("The validity monitor exited with an error")
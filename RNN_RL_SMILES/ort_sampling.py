@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+import json
+import numpy as np
+import onnxruntime as ort
+
+
+def _log_softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+
+
+class OnnxSampler():
+    """Samples SMILES from a model exported with RNN.export_onnx, using ONNX
+       Runtime for the network and numpy for everything else, so it runs
+       without PyTorch. The exported graph is a single step of the network
+       (token and hidden state in, logits and hidden state out); the decode
+       loop is the same as in RNN.sample, including dropping finished rows.
+       The ONNX Runtime session is created on first use, so a sampler that
+       has not run yet can be handed to forked processes, which reseed it.
+
+        Args:
+                path : location of the .onnx file, with its vocabulary in path + '.json'
+                seed : seed of the numpy random number generator
+                n_threads : number of threads ONNX Runtime uses, all cores if None
+    """
+    def __init__(self, path, seed=None, n_threads=None):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.chars = meta['chars']
+        self.go = meta['go']
+        self.eos = meta['eos']
+        self.h_shape = (meta['num_layers'], meta['hidden_size'])
+        self.path = path
+        self.n_threads = n_threads
+        self._session = None
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def session(self):
+        if self._session is None:
+            options = ort.SessionOptions()
+            if self.n_threads:
+                options.intra_op_num_threads = self.n_threads
+            self._session = ort.InferenceSession(self.path, options, providers=['CPUExecutionProvider'])
+        return self._session
+
+    def reseed(self, seed, n_threads=None):
+        """Restarts the random number generator from seed, and sets the number of
+           threads of a session that has not been created yet"""
+        self.rng = np.random.default_rng(seed)
+        self.n_threads = n_threads
+
+    def step(self, x, h):
+        """Runs one step of the network, returns (logits, h)"""
+        return self.session.run(['logits', 'h_out'], {'token': x, 'h': h})
+
+    def init_h(self, batch_size):
+        return np.zeros((self.h_shape[0], batch_size, self.h_shape[1]), dtype=np.float32)
+
+    def sample(self, batch_size, max_length=140):
+        """
+            Sample a batch of sequences
+
+            Args:
+                batch_size : Number of sequences to sample
+                max_length:  Maximum length of the sequences
+
+            Outputs:
+            seqs: (batch_size, seq_length) int64 array of the sampled sequences, padded
+                                           with the END token after it is sampled.
+            log_probs : (batch_size) Log likelihood for each sequence
+            entropy: (batch_size) The entropies for the sequences
+        """
+        h = self.init_h(batch_size)
+        x = np.full(batch_size, self.go, dtype=np.int64)
+        sequences = np.full((batch_size, max_length), self.eos, dtype=np.int64)
+        log_probs = np.zeros(batch_size, dtype=np.float32)
+        entropies = np.zeros(batch_size, dtype=np.float32)
+        active = np.arange(batch_size)
+
+        for step in range(max_length):
+            logits, h = self.step(x, h)
+            log_prob = _log_softmax(logits)
+            prob = np.exp(log_prob)
+            # Inverse CDF sampling of one token per row
+            u = self.rng.random((len(x), 1), dtype=np.float32)
+            x = np.minimum((np.cumsum(prob, axis=1) < u * prob.sum(axis=1, keepdims=True)).sum(axis=1),
+                           prob.shape[1] - 1)
+            sequences[active, step] = x
+            log_probs[active] += log_prob[np.arange(len(x)), x]
+            entropies[active] -= (log_prob * prob).sum(axis=1)
+
+            unfinished = np.flatnonzero(x != self.eos)
+            if len(unfinished) == 0: break
+            if len(unfinished) < len(active):
+                active = active[unfinished]
+                x = x[unfinished]
+                h = np.ascontiguousarray(h[:, unfinished])
+
+        return sequences[:, :step + 1], log_probs, entropies
+
+    def likelihood(self, seqs):
+        """
+            Teacher-forced log likelihood of (batch_size, seq_length) int64
+            sequences, counting each one up to and including its first END token
+        """
+        batch_size, seq_length = seqs.shape
+        h = self.init_h(batch_size)
+        x = np.full(batch_size, self.go, dtype=np.int64)
+        log_probs = np.zeros(batch_size, dtype=np.float32)
+        finished = np.zeros(batch_size, dtype=bool)
+        for step in range(seq_length):
+            logits, h = self.step(x, h)
+            x = seqs[:, step]
+            log_probs += np.where(finished, 0, _log_softmax(logits)[np.arange(batch_size), x])
+            finished |= x == self.eos
+        return log_probs
+
+    def decode(self, seq):
+        """Turns a sequence of token indices into a SMILES, like Vocabulary.decode"""
+        chars = []
+        for i in seq:
+            if i == self.eos: break
+            chars.append(self.chars[i])
+        return "".join(chars).replace("L", "Cl").replace("R", "Br")
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+import math
+import queue
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from rdkit import Chem
+from rdkit.Chem import AllChem
+
+
+def is_valid_smiles(smile):
+    """
+    Checks that a sampled SMILES can be parsed by RDKit and fingerprinted
+    Args:
+        smile: SMILES string
+
+    Returns: True if the SMILES is valid
+
+    """
+    mol = Chem.MolFromSmiles(smile)
+    if mol is None:
+        return False
+    try:
+        AllChem.GetMorganFingerprintAsBitVect(mol, 2, 1024)
+    except:
+        return False
+    return True
+
+
+def sample_until(model, nums, output, min_batch=64, max_batch=4096):
+    """
+    Samples from the model in batches until exactly nums valid, unique SMILES
+    have been written. After each batch the size of the next one is estimated
+    from the fraction of valid, unique SMILES observed so far.
+    Args:
+        model: RNN to sample from
+        nums: number of valid, unique SMILES to write
+        output: open file the SMILES are written to, one per line
+        min_batch: smallest batch size to sample
+        max_batch: largest batch size to sample
+
+    Returns: total number of sequences sampled
+
+    """
+    seen = set()
+    valid = 0
+    n_sample = 0
+    batch_size = min_batch
+    while valid < nums:
+        seqs = model.generate(batch_size)
+        n_sample += batch_size
+        for seq in seqs.cpu().numpy():
+            smile = model.voc.decode(seq)
+            if smile in seen:
+                continue
+            seen.add(smile)
+            if is_valid_smiles(smile):
+                valid += 1
+                output.write(smile + '\n')
+                if valid == nums:
+                    break
+        rate = max(valid / n_sample, 1 / max_batch)
+        batch_size = int(math.ceil((nums - valid) / rate))
+        batch_size = min(max(batch_size, min_batch), max_batch)
+    return n_sample
+
+
+def sample_chunks(model, nums, chunk_size=1024):
+    """
+    Generator that samples nums sequences from the model in chunks of at most
+    chunk_size, so only one chunk is held in memory at a time.
+    Args:
+        model: RNN to sample from
+        nums: total number of sequences to sample
+        chunk_size: number of sequences sampled per model call
+
+    Returns: yields a list of decoded SMILES for each chunk
+
+    """
+    for start in range(0, nums, chunk_size):
+        seqs = model.generate(min(chunk_size, nums - start))
+        yield [model.voc.decode(seq) for seq in seqs.cpu().numpy()]
+
+
+def sample_streaming(model, nums, output, chunk_size=1024):
+    """
+    Samples nums sequences chunk by chunk and writes the valid SMILES to the
+    output as each chunk is processed. Duplicates are removed across chunks;
+    the set of SMILES seen so far is the only state that grows with nums.
+    Args:
+        model: RNN to sample from
+        nums: total number of sequences to sample
+        output: open file the SMILES are written to, one per line
+        chunk_size: number of sequences sampled per model call
+
+    Returns: number of valid, unique SMILES written
+
+    """
+    seen = set()
+    valid = 0
+    for smiles in sample_chunks(model, nums, chunk_size):
+        for smile in smiles:
+            if smile in seen:
+                continue
+            seen.add(smile)
+            if is_valid_smiles(smile):
+                valid += 1
+                output.write(smile + '\n')
+        output.flush()
+    return valid
+
+
+def _sample_worker(model, nums, chunk_size, seed, results):
+    """Worker process for sample_parallel, sends the valid SMILES of each chunk to results"""
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    if model.onnx is not None:
+        model.onnx.reseed(seed, n_threads=1)
+    seen = set()
+    for smiles in sample_chunks(model, nums, chunk_size):
+        valid_smiles = []
+        for smile in smiles:
+            if smile in seen:
+                continue
+            seen.add(smile)
+            if is_valid_smiles(smile):
+                valid_smiles.append(smile)
+        results.put(valid_smiles)
+    results.put(None)
+
+
+def sample_parallel(model, nums, output, n_workers=None, chunk_size=1024, seed=None):
+    """
+    Samples nums sequences split across n_workers forked processes. The workers
+    share the model weights read-only and each one uses its own RNG stream
+    (seed + worker index). The parent process removes duplicates across all
+    workers and writes the merged valid SMILES to the output. Sharded sampling
+    runs on the CPU only: CUDA cannot be used in forked processes, so this
+    raises a RuntimeError on CUDA hosts. A model sampling with ONNX Runtime
+    (RNN.use_onnx) must not have sampled before, since its session cannot be
+    used across fork; each worker starts its own.
+    Args:
+        model: RNN to sample from
+        nums: total number of sequences to sample
+        output: open file the SMILES are written to, one per line
+        n_workers: number of worker processes, defaults to the number of CPUs
+        chunk_size: number of sequences sampled per model call in each worker
+        seed: base seed for the worker RNG streams
+
+    Returns: number of valid, unique SMILES written
+
+    """
+    if n_workers is None:
+        n_workers = mp.cpu_count()
+    if seed is None:
+        seed = torch.initial_seed() % 2**32
+    if torch.cuda.is_available():
+        raise RuntimeError("Sampling with several worker processes only runs on the CPU, but CUDA is available; "
+                           "sample with a single process on the GPU instead")
+    if model.onnx is not None and model.onnx._session is not None:
+        raise RuntimeError("The ONNX Runtime session of the model was started before forking the workers; "
+                           "call use_onnx again before sample_parallel")
+    ctx = mp.get_context('fork')
+    model.rnn.share_memory()
+    results = ctx.Queue(maxsize=4 * n_workers)
+    workers = []
+    for rank in range(n_workers):
+        share = nums // n_workers + (1 if rank < nums % n_workers else 0)
+        worker = ctx.Process(target=_sample_worker,
+                             args=(model, share, chunk_size, seed + rank, results))
+        worker.start()
+        workers.append(worker)
+
+    seen = set()
+    valid = 0
+    running = n_workers
+    while running:
+        try:
+            smiles = results.get(timeout=10)
+        except queue.Empty:
+            if any(worker.exitcode not in (None, 0) for worker in workers):
+                for worker in workers:
+                    worker.terminate()
+                raise RuntimeError("A sampling worker exited with an error")
+            continue
+        if smiles is None:
+            running -= 1
+            continue
+        for smile in smiles:
+            if smile not in seen:
+                seen.add(smile)
+                valid += 1
+                output.write(smile + '\n')
+        output.flush()
+    for worker in workers:
+        worker.join()
+    return valid
+
+
+def compare_models(reference, candidate, nums=1024, seed=0, known=None):
+    """
+    Compares a faster variant of a model (quantized, distilled, ...) with the
+    model it was made from. Both sample nums molecules from the same seed, and
+    the molecules of the reference are scored by both models.
+    Args:
+        reference: RNN the candidate should match
+        candidate: RNN to compare
+        nums: number of molecules sampled from each model
+        seed: seed both models sample with
+        known: optional set of training SMILES, to also report the fraction of
+               valid, unique SMILES of each model that are novel
+
+    Returns: dict with the fraction of valid and of unique SMILES and the
+             sampling time of each model, and the mean and largest absolute
+             difference of the log likelihoods of the reference molecules
+
+    """
+    report = {}
+    for name, model in (('reference', reference), ('candidate', candidate)):
+        torch.manual_seed(seed)
+        start = time.time()
+        seqs = model.generate(nums)
+        report[name + '_time'] = time.time() - start
+        smiles = [model.voc.decode(seq) for seq in seqs.cpu().numpy()]
+        valid_smiles = set(smile for smile in smiles if is_valid_smiles(smile))
+        report[name + '_validity'] = sum(smile in valid_smiles for smile in smiles) / nums
+        report[name + '_uniqueness'] = len(set(smiles)) / nums
+        if known is not None:
+            report[name + '_novelty'] = len(valid_smiles - known) / max(len(valid_smiles), 1)
+        if name == 'reference':
+            reference_seqs = seqs
+    with torch.no_grad():
+        reference_ll, _ = reference.likelihood(reference_seqs)
+        candidate_ll, _ = candidate.likelihood(reference_seqs)
+    delta = (candidate_ll.cpu() - reference_ll.cpu()).abs()
+    report['likelihood_delta_mean'] = delta.mean().item()
+    report['likelihood_delta_max'] = delta.max().item()
+    report['speedup'] = report['reference_time'] / report['candidate_time']
+    return report
+
+
+def format_report(report):
+    """Formats the dict returned by compare_models for printing"""
+    lines = ["{:<12}{:>12}{:>12}".format('', 'reference', 'candidate')]
+    for key in ('validity', 'uniqueness', 'novelty'):
+        if 'reference_' + key not in report:
+            continue
+        lines.append("{:<12}{:>11.1f}%{:>11.1f}%".format(
+            key, 100 * report['reference_' + key], 100 * report['candidate_' + key]))
+    lines.append("{:<12}{:>11.2f}s{:>11.2f}s".format('time', report['reference_time'], report['candidate_time']))
+    lines.append("speedup: {:.2f}x    |delta log likelihood|: mean {:.4f}, max {:.4f}".format(
+        report['speedup'], report['likelihood_delta_mean'], report['likelihood_delta_max']))
+    return '\n'.join(lines)
+
+
+def onnx_parity(model, path, nums=64, seed=0):
+    """
+    Checks an export written by RNN.export_onnx against the torch model: nums
+    molecules are sampled from the torch model with seed and scored by both
+    Args:
+        model: RNN the export was made from
+        path: location of the .onnx file
+        nums: number of molecules to score
+        seed: seed the molecules are sampled with
+
+    Returns: largest absolute difference of the log likelihoods
+
+    """
+    from ort_sampling import OnnxSampler
+    torch.manual_seed(seed)
+    seqs = model.generate(nums)
+    with torch.no_grad():
+        torch_ll, _ = model.likelihood(seqs)
+    onnx_ll = OnnxSampler(path).likelihood(seqs.cpu().numpy())
+    return float(np.abs(onnx_ll - torch_ll.cpu().numpy()).max())
@@ -1,19 +1,62 @@
 #!usr/bin/env python
 
+import argparse
+import os
+import time
+import numpy as np
 import torch
+import torch.distributed as dist
 from torch.utils.data import DataLoader
 import pickle
-from rdkit import Chem, rdBase
+from rdkit import rdBase
 from tqdm import tqdm
 
-from data_structs import MolData, Vocabulary
+from data_structs import MolData, TokenizedMolData, Vocabulary, BucketBatchSampler
 from model import RNN
-from utils import Variable, decrease_learning_rate
+from checkpoint import CheckpointWriter, run_state, restore_run_state
+from monitor import ValidityMonitor
+from validation import validation_nll, EarlyStopping
+from utils import Variable, LearningRateDecay, scale_learning_rate, allreduce_gradients, accumulation_size
 rdBase.DisableLog('rdApp.error')
 
 
-def pretrain(restore_from=None):
-    "Train the Prior RNN"
+def pretrain(restore_from=None, tokenized_data=None, num_workers=4, prefetch_factor=4,
+             distributed=False, batch_size=10, accum_steps=1, keep_checkpoints=1,
+             resume_from=None, valid_data=None, patience=None):
+    """Train the Prior RNN. restore_from loads the weights of a saved Prior,
+       while resume_from continues a stopped run from the full run state that
+       is saved to data/Prior_local.state next to every checkpoint: weights,
+       Adam moments, learning rate decay, epoch and step, data order and RNG
+       states. If tokenized_data is given, it is the prefix of a
+       dataset written by compile_mol_data and is used instead of the SMILES file.
+       Batches are built by num_workers persistent DataLoader workers, each
+       keeping prefetch_factor batches ready.
+
+       Gradients of accum_steps micro-batches of batch_size molecules are
+       accumulated before each optimizer step. The learning rate, tuned for
+       steps of 10 molecules, is scaled to the effective batch size with
+       scale_learning_rate, and it decays every 1000 molecules whatever the
+       batch size.
+
+       With distributed=True the process joins a gloo process group set up by
+       torchrun (torchrun --nproc_per_node=K train_prior.py). The batches are
+       sharded over the processes and gradients are averaged before every
+       optimizer step, which then covers K times as many molecules. Only
+       rank 0 samples, logs and saves checkpoints.
+
+       Checkpoints are written in the background by a CheckpointWriter, which
+       keeps the last keep_checkpoints of them, and the validity of sampled
+       SMILES is checked in a separate process by a ValidityMonitor.
+
+       If valid_data is given, it is a held-out SMILES file whose mean NLL per
+       token is computed at the end of every epoch. The weights of the best
+       epoch are saved to data/Prior_local.ckpt.best, and training stops once
+       the validation loss has not improved for patience epochs."""
+    if distributed:
+        dist.init_process_group('gloo')
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+    else:
+        rank, world_size = 0, 1
 
     # Reads vocabulary from a file
     # voc = Vocabulary(init_from_file="data/Voc")
@@ -21,60 +64,135 @@ def pretrain(restore_from=None):
 
     # Create a Dataset from a SMILES file
     # moldata = MolData("data/ChEMBL_filtered", voc)
-    moldata = MolData("data/danish.smi", voc)
-    data = DataLoader(moldata, batch_size=10, shuffle=True, drop_last=True,
-                     collate_fn=MolData.collate_fn)
+    if tokenized_data:
+        moldata = TokenizedMolData(tokenized_data)
+    else:
+        moldata = MolData("data/danish.smi", voc)
+    valid_moldata = MolData(valid_data, voc) if valid_data else None
+    early_stopping = EarlyStopping(patience)
+    sampler = BucketBatchSampler(moldata.lengths(), batch_size=batch_size, drop_last=True,
+                                 num_replicas=world_size, rank=rank,
+                                 seed=0 if distributed else int(np.random.randint(2 ** 31)))
+    loader_kwargs = {}
+    if num_workers > 0:
+        loader_kwargs = dict(prefetch_factor=prefetch_factor, persistent_workers=True)
+    data = DataLoader(moldata, batch_sampler=sampler, collate_fn=MolData.collate_fn,
+                      num_workers=num_workers, pin_memory=torch.cuda.is_available(),
+                      **loader_kwargs)
     print("in pretrain(), voc: ", voc)
-    Prior = RNN(voc)
+    Prior = RNN(voc, fused=True)
 
     # Can restore from a  saved RNN
     if restore_from:
-        Prior.rnn.load_state_dict(torch.loag(restore_from))
-
-    optimizer = torch.optim.Adam(Prior.rnn.parameters(), lr=0.001)
-
-    for epoch in range(1, 6):
+        Prior.rnn.load_state_dict(torch.load(restore_from, map_location=lambda storage, loc: storage))
+
+    if distributed:
+        # Start every process from the weights of rank 0
+        for param in Prior.rnn.parameters():
+            dist.broadcast(param.data, 0)
+
+    # Number of molecules behind every optimizer step
+    update_size = batch_size * accum_steps * world_size
+    optimizer = torch.optim.Adam(Prior.rnn.parameters(), lr=scale_learning_rate(0.001, update_size, 10))
+    lr_decay = LearningRateDecay(optimizer, decay_every=1000, decrease_by=0.03)
+    if rank == 0:
+        checkpoint = CheckpointWriter('data/Prior_local.ckpt', keep=keep_checkpoints)
+        state_checkpoint = CheckpointWriter('data/Prior_local.state', keep=keep_checkpoints)
+        monitor = ValidityMonitor(voc)
+        best_checkpoint = CheckpointWriter('data/Prior_local.ckpt.best')
+
+    start_epoch, start_step = 1, 0
+    if resume_from:
+        state = torch.load(resume_from, map_location=lambda storage, loc: storage, weights_only=False)
+        start_epoch, start_step, extra = restore_run_state(state, Prior.rnn, optimizer, lr_decay, sampler)
+        early_stopping.load_state_dict(extra['early_stopping'])
+
+    for epoch in range(start_epoch, 6):
         # When training on a few million compounds, this model converges
         # in a few of epochs or even faster. If model sized is increased
         # its probably a good idea to check loss against an external set of
         # validation SMILES to make sure we dont overfit too much.
-        
-        for step, batch in tqdm(enumerate(data), total=len(data)):
+
+        first_step = start_step if epoch == start_epoch else 0
+        sampler.set_epoch(epoch, start_batch=first_step)
+        optimizer.zero_grad()
+        # Time spent waiting on the DataLoader for the next batch
+        data_wait = 0.0
+        wait_start = time.time()
+        for step, batch in tqdm(enumerate(data, first_step), total=len(data), initial=first_step,
+                                disable=rank != 0):
             # Sample from Dataloader
-            seqs = batch.long()
+            data_wait += time.time() - wait_start
+            seqs, seq_lens = batch
+            seqs = Variable(seqs)
 
             # Calculate loss
-            log_p, _ = Prior.likelihood(seqs)
+            log_p, _ = Prior.likelihood(seqs, seq_lens)
             loss = - log_p.mean()
 
-            # Calculate gradients and take a step
-            optimizer.zero_grad()
-            loss.backward()
+            # Accumulate gradients and take a step every accum_steps batches
+            n_accum = accumulation_size(step, len(data), accum_steps)
+            (loss / n_accum).backward()
+            if (step + 1) % accum_steps != 0 and step + 1 != len(data):
+                wait_start = time.time()
+                continue
+            if distributed:
+                allreduce_gradients(Prior.rnn)
             optimizer.step()
+            optimizer.zero_grad()
 
-            # Every 500 steps we decrease learning rate and print some information
-            if step % 100 == 0 and step != 0:
-                decrease_learning_rate(optimizer, decrease_by=0.03)
+            # Every 1000 molecules we decrease learning rate and print some information
+            if lr_decay.step(update_size * n_accum // accum_steps) and rank == 0:
                 tqdm.write('*'*50)
                 # print("loss.data.item()", loss.data.item())
                 # tqdm.write("Epoch {:3d}   step {:3d}    loss: {:5.2f}\n".format(epoch, step, loss.data[0]))
-                tqdm.write("Epoch {:3d}   step {:3d}    loss: {:5.2f}\n".format(epoch, step, loss.data.item()))
-                seqs, likelihood, _ = Prior.sample(128)
-                valid = 0
-                for i, seq in enumerate(seqs.cpu().numpy()):
-                    smile = voc.decode(seq)
-                    if Chem.MolFromSmiles(smile):
-                        valid += 1
-                    if i < 5:
-                        tqdm.write(smile)
-                tqdm.write("\n{:>4.1f}% valid SMILES".format(100 * valid / len(seqs)))
-                tqdm.write('*'*50 + '\n')
-                torch.save(Prior.rnn.state_dict(), 'data/Prior_local.ckpt')
-        # Save the prior
-        torch.save(Prior.rnn.state_dict(), 'data/Prior_local.ckpt')
+                tqdm.write("Epoch {:3d}   step {:3d}    loss: {:5.2f}    data wait: {:6.2f} ms/step\n".format(
+                    epoch, step, loss.data.item(), 1000 * data_wait / (step + 1 - first_step)))
+                monitor.check(Prior.rnn, 128, epoch, step)
+                checkpoint.save(Prior.rnn.state_dict())
+                state_checkpoint.save(run_state(Prior.rnn, optimizer, lr_decay, sampler, epoch, step + 1,
+                                                early_stopping=early_stopping.state_dict()))
+            wait_start = time.time()
+        # Every process evaluates the same weights, so they all agree on when to stop
+        improved = False
+        if valid_moldata is not None:
+            valid_loss = validation_nll(Prior, valid_moldata)
+            improved = early_stopping.step(valid_loss, epoch)
+        if rank == 0:
+            tqdm.write("Epoch {:3d}   padding: {:4.1f}% of batch tokens    data wait: {:6.2f} ms/step".format(
+                epoch, 100 * sampler.padding_ratio(), 1000 * data_wait / max(len(data) - first_step, 1)))
+            if valid_moldata is not None:
+                tqdm.write("Epoch {:3d}   validation NLL: {:6.4f} per token    best: {:6.4f} (epoch {})".format(
+                    epoch, valid_loss, early_stopping.best, early_stopping.best_epoch))
+            # Save the prior
+            checkpoint.save(Prior.rnn.state_dict())
+            if improved:
+                best_checkpoint.save(Prior.rnn.state_dict())
+            state_checkpoint.save(run_state(Prior.rnn, optimizer, lr_decay, sampler, epoch + 1, 0,
+                                            early_stopping=early_stopping.state_dict()))
+        if early_stopping.should_stop:
+            if rank == 0:
+                tqdm.write("No improvement for {} epochs, stopping".format(early_stopping.bad_epochs))
+            break
+
+    if rank == 0:
+        checkpoint.close()
+        state_checkpoint.close()
+        best_checkpoint.close()
+        monitor.close()
+    if distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':
-    pretrain()
+    parser = argparse.ArgumentParser(description="Train the Prior RNN")
+    parser.add_argument('--resume', action='store', dest='resume_from', default=None,
+                        help='Run state to continue a stopped run from, e.g. data/Prior_local.state')
+    parser.add_argument('--keep_checkpoints', action='store', dest='keep_checkpoints', default=1, type=int,
+                        help='Number of checkpoints to keep')
+    arg_dict = vars(parser.parse_args())
+    # torchrun sets WORLD_SIZE for every process it launches
+    pretrain(distributed='WORLD_SIZE' in os.environ, keep_checkpoints=arg_dict['keep_checkpoints'],
+             resume_from=arg_dict['resume_from'])
 
 
@@ -6,10 +6,11 @@ import pickle
 from rdkit import Chem
 from rdkit import rdBase
 from tqdm import tqdm
-from rdkit.Chem import AllChem
 from data_structs import MolData, Vocabulary
 from model import RNN
-from utils import Variable, decrease_learning_rate, unique
+from checkpoint import CheckpointWriter
+from sampling import sample_until, sample_streaming
+from utils import Variable, LearningRateDecay, scale_learning_rate, accumulation_size
 rdBase.DisableLog('rdApp.error')
 
 
@@ -26,16 +27,17 @@ def cano_smi_file(fname, outfn):
     out.close()
 
 
-def train_model():
-    """Do transfer learning for generating SMILES"""
+def train_model(batch_size=64, accum_steps=1):
+    """Do transfer learning for generating SMILES. Gradients of accum_steps
+       micro-batches of batch_size molecules are accumulated per optimizer step."""
     voc = Vocabulary(init_from_file='data/Voc')
     cano_smi_file('refined_smii.csv', 'refined_smii_cano.csv')
     moldata = MolData('refined_smii_cano.csv', voc)
     # Monomers 67 and 180 were removed because of the unseen [C-] in voc
     # DAs containing [se] [SiH2] [n] removed: 38 molecules
-    data = DataLoader(moldata, batch_size=64, shuffle=True, drop_last=False,
+    data = DataLoader(moldata, batch_size=batch_size, shuffle=True, drop_last=False,
                       collate_fn=MolData.collate_fn)
-    transfer_model = RNN(voc)
+    transfer_model = RNN(voc, fused=True)
 
     if torch.cuda.is_available():
         transfer_model.rnn.load_state_dict(torch.load('data/Prior.ckpt'))
@@ -44,24 +46,31 @@ def train_model():
 
     # for param in transfer_model.rnn.parameters():
     #     param.requires_grad = False
-    optimizer = torch.optim.Adam(transfer_model.rnn.parameters(), lr=0.001)
+    update_size = batch_size * accum_steps
+    optimizer = torch.optim.Adam(transfer_model.rnn.parameters(), lr=scale_learning_rate(0.001, update_size, 64))
+    lr_decay = LearningRateDecay(optimizer, decay_every=320, decrease_by=0.03)
+    step_checkpoint = CheckpointWriter("data/transfer_model2.ckpt")
+    epoch_checkpoint = CheckpointWriter("data/transfer_modelw.ckpt")
 
     for epoch in range(1, 10):
 
+        optimizer.zero_grad()
         for step, batch in tqdm(enumerate(data), total=len(data)):
-            seqs = batch.long()
-            log_p, _ = transfer_model.likelihood(seqs)
+            seqs, seq_lens = batch
+            log_p, _ = transfer_model.likelihood(seqs, seq_lens)
             loss = -log_p.mean()
 
-            optimizer.zero_grad()
-            loss.backward()
+            n_accum = accumulation_size(step, len(data), accum_steps)
+            (loss / n_accum).backward()
+            if (step + 1) % accum_steps != 0 and step + 1 != len(data):
+                continue
             optimizer.step()
+            optimizer.zero_grad()
 
-            if step % 5 == 0 and step != 0:
-                decrease_learning_rate(optimizer, decrease_by=0.03)
+            if lr_decay.step(update_size * n_accum // accum_steps):
                 tqdm.write('*'*50)
-                tqdm.write("Epoch {:3d}   step {:3d}    loss: {:5.2f}\n".format(epoch, step, loss.data[0]))
-                seqs, likelihood, _ = transfer_model.sample(128)
+                tqdm.write("Epoch {:3d}   step {:3d}    loss: {:5.2f}\n".format(epoch, step, loss.data.item()))
+                seqs = transfer_model.generate(128)
                 valid = 0
                 for i, seq in enumerate(seqs.cpu().numpy()):
                     smile = voc.decode(seq)
@@ -71,9 +80,12 @@ def train_model():
                         tqdm.write(smile)
                 tqdm.write("\n{:>4.1f}% valid SMILES".format(100*valid/len(seqs)))
                 tqdm.write("*"*50 + '\n')
-                torch.save(transfer_model.rnn.state_dict(), "data/transfer_model2.ckpt")
+                step_checkpoint.save(transfer_model.rnn.state_dict())
 
-        torch.save(transfer_model.rnn.state_dict(), "data/transfer_modelw.ckpt")
+        epoch_checkpoint.save(transfer_model.rnn.state_dict())
+
+    step_checkpoint.close()
+    epoch_checkpoint.close()
 
 
 def sample_smiles(nums, outfn, until=False):
@@ -93,46 +105,14 @@ def sample_smiles(nums, outfn, until=False):
 
     if not until:
 
-        seqs, likelihood, _ = transfer_model.sample(nums)
-        valid = 0
+        valid = sample_streaming(transfer_model, nums, output)
         double_br = 0
-        unique_idx = unique(seqs)
-        seqs = seqs[unique_idx]
-        for i, seq in enumerate(seqs.cpu().numpy()):
-
-            smile = voc.decode(seq)
-            if Chem.MolFromSmiles(smile):
-                try:
-                    AllChem.GetMorganFingerprintAsBitVect(Chem.MolFromSmiles(smile), 2, 1024)
-                    valid += 1
-                    output.write(smile+'\n')
-                except:
-                    continue
-            #if smile.count('Br') == 2:
-            #    double_br += 1
-            #output.write(smile+'\n')
         tqdm.write('\n{} molecules sampled, {} valid SMILES, {} with double Br'.format(nums, valid, double_br))
         output.close()
     else:
-        valid = 0;
-        n_sample = 0
-        while valid < nums:
-            seq, likelihood, _ = transfer_model.sample(1)
-            n_sample += 1
-            seq = seq.cpu().numpy()
-            seq = seq[0]
-            # print(seq)
-            smile = voc.decode(seq)
-            if Chem.MolFromSmiles(smile):
-                try:
-                    AllChem.GetMorganFingerprintAsBitVect(Chem.MolFromSmiles(smile), 2, 1024)
-                    valid += 1
-                    output.write(smile + '\n')
-                    if valid % 100 == 0 and valid != 0:
-                        tqdm.write('\n{} valid molecules sampled, with {} of total samples'.format(valid, n_sample))
-                except:
-                    continue
+        n_sample = sample_until(transfer_model, nums, output)
         tqdm.write('\n{} valid molecules sampled, with {} of total samples'.format(nums, n_sample))
+        output.close()
 
 
 if __name__ == "__main__":
@@ -1,18 +1,25 @@
 #!/usr/bin/env python
 
+import copy
+import os
 import torch
 from torch.utils.data import DataLoader
 import pickle
 from rdkit import Chem
 from rdkit import rdBase
 from tqdm import tqdm
-from rdkit.Chem import AllChem
-from data_structs import MolData, Vocabulary
+from data_structs import MolData, Vocabulary, BucketBatchSampler, FeatureCache
 from model import RNN
-from utils import Variable, decrease_learning_rate, unique
+from checkpoint import CheckpointWriter, run_state, restore_run_state
+from sampling import sample_until, sample_streaming, sample_parallel, compare_models, format_report, \
+    onnx_parity
+from monitor import ValidityMonitor
+from adapters import add_adapters, adapter_state_dict, is_adapter_state_dict, merge_adapters
+from validation import validation_nll, EarlyStopping
+from utils import Variable, LearningRateDecay, scale_learning_rate, accumulation_size
 import torch.nn as nn
 import argparse
-import pandas as pd
+import numpy as np
 rdBase.DisableLog('rdApp.error')
 
 
@@ -35,7 +42,9 @@ def cano_smi_file(fname, outfn):
     out.close()
 
 
-def train_model(voc_dir, smi_dir, prior_dir, tf_dir,tf_process_dir,freeze=False):
+def train_model(voc_dir, smi_dir, prior_dir, tf_dir,tf_process_dir,freeze=False, batch_size=10, accum_steps=1,
+                keep_checkpoints=1, resume_from=None, valid_dir=None, patience=None, feature_cache=None,
+                adapter_rank=None):
     """
     Transfer learning on target molecules using the SMILES structures
     Args:
@@ -43,154 +52,319 @@ def train_model(voc_dir, smi_dir, prior_dir, tf_dir,tf_process_dir,freeze=False)
         smi_dir: location of the SMILES file used for transfer learning
         prior_dir: location of prior trained model to initialize transfer learning
         tf_dir: location to save the transfer learning model
-        tf_process_dir: location to save the SMILES sampled while doing transfer learning
+        tf_process_dir: location to save the SMILES sampled while doing transfer learning. The valid SMILES of
+        1024 molecules sampled at the end of every epoch are appended to it by a ValidityMonitor process.
         freeze: Bool. If true, all parameters in the RNN will be frozen except for the last linear layer during
-        transfer learning.
+        transfer learning. The frozen GRU layers are then run once over the transfer set, and the linear layer is
+        trained on their cached outputs (see FeatureCache).
+        batch_size: number of molecules per micro-batch
+        accum_steps: number of micro-batches whose gradients are accumulated before each optimizer step. The
+        learning rate is scaled to batch_size * accum_steps and decays every 800 molecules.
+        keep_checkpoints: number of checkpoints kept at tf_dir, tf_dir.1, ... They are written in the background.
+        resume_from: location of a run state to continue a stopped run from. The full run state (weights, Adam
+        moments, learning rate decay, epoch and step, data order and RNG states) is saved to tf_dir + '.state'
+        next to every checkpoint. On resume, the sampled SMILES are appended to the existing tf_process_dir.
+        valid_dir: location of a held-out SMILES file. If given, its mean NLL per token is computed after every
+        epoch and the weights of the best epoch are saved to tf_dir + '.best'.
+        patience: number of epochs without improvement of the validation loss after which training stops.
+        feature_cache: with freeze=True, location of a .npy file to memory-map the cached GRU outputs to. If None,
+        they are kept in memory.
+        adapter_rank: if given, the prior is frozen and only low-rank adapters of this rank on the GRU and linear
+        weights are trained (see add_adapters). The checkpoints at tf_dir then only hold the adapters, which
+        sample_smiles merges into the prior weights. Cannot be combined with freeze.
 
     Returns: None
 
     """
+    if freeze and adapter_rank:
+        raise ValueError("freeze and adapter_rank cannot be used together")
     voc = Vocabulary(init_from_file=voc_dir)
     print("voc", voc)
     #cano_smi_file('all_smi_refined.csv', 'all_smi_refined_cano.csv') # writes to a file
     # cano_smi_file('data/refined_smi_test.csv', 'all_smi_refined_cano.csv')
     moldata = MolData(smi_dir, voc)
+    valid_moldata = MolData(valid_dir, voc) if valid_dir else None
+    early_stopping = EarlyStopping(patience)
     # Monomers 67 and 180 were removed because of the unseen [C-] in voc
     # DAs containing [C] removed: 43 molecules in 5356; Ge removed: 154 in 5356; [c] removed 4 in 5356
     # [S] 1 molecule in 5356
-    data = DataLoader(moldata, batch_size=10, shuffle=True, drop_last=False,
-                      collate_fn=MolData.collate_fn)
+    sampler = BucketBatchSampler(moldata.lengths(), batch_size=batch_size, drop_last=False,
+                                 seed=int(np.random.randint(2 ** 31)))
+    data = DataLoader(moldata, batch_sampler=sampler, collate_fn=MolData.collate_fn)
     print("inside train_model voc.vocab_size: ", voc.vocab_size)
-    transfer_model = RNN(voc)
+    transfer_model = RNN(voc, fused=True)
     # if freeze=True, freeze all parameters except those in the linear layer
     if freeze:
         for param in transfer_model.rnn.parameters():
             param.requires_grad = False
-        transfer_model.rnn.linear = nn.Linear(512, voc.vocab_size)
+        transfer_model.rnn.linear = nn.Linear(transfer_model.rnn.hidden_size, voc.vocab_size)
     if torch.cuda.is_available():
         transfer_model.rnn.load_state_dict(torch.load(prior_dir))
     else:
         transfer_model.rnn.load_state_dict(torch.load(prior_dir,
                                                       map_location=lambda storage, loc: storage))
+    if freeze:
+        features = FeatureCache.build(transfer_model, moldata, path=feature_cache)
+        data = DataLoader(features, batch_sampler=sampler, collate_fn=FeatureCache.collate_fn)
 
-    optimizer = torch.optim.Adam(transfer_model.rnn.parameters(), lr=0.0005)
+    if adapter_rank:
+        params = add_adapters(transfer_model.rnn, rank=adapter_rank)
+    else:
+        params = transfer_model.rnn.parameters()
 
-    smi_lst = []; epoch_lst = []
-    for epoch in range(1, 11):
+    def weights():
+        if adapter_rank:
+            return adapter_state_dict(transfer_model.rnn)
+        return transfer_model.rnn.state_dict()
+
+    update_size = batch_size * accum_steps
+    optimizer = torch.optim.Adam(params, lr=scale_learning_rate(0.0005, update_size, 10))
+    lr_decay = LearningRateDecay(optimizer, decay_every=800, decrease_by=0.03)
+    checkpoint = CheckpointWriter(tf_dir, keep=keep_checkpoints)
+    state_checkpoint = CheckpointWriter(tf_dir + '.state', keep=keep_checkpoints)
+    best_checkpoint = CheckpointWriter(tf_dir + '.best')
+
+    # Sampled SMILES are checked and appended to tf_process_dir in the background
+    monitor = ValidityMonitor(voc, tf_process_dir, append=bool(resume_from))
+
+    start_epoch, start_step = 1, 0
+    if resume_from:
+        state = torch.load(resume_from, map_location=lambda storage, loc: storage, weights_only=False)
+        start_epoch, start_step, extra = restore_run_state(state, transfer_model.rnn, optimizer, lr_decay, sampler)
+        early_stopping.load_state_dict(extra['early_stopping'])
+    for epoch in range(start_epoch, 11):
 
-        for step, batch in tqdm(enumerate(data), total=len(data)):
-            seqs = batch.long()
-            log_p, _ = transfer_model.likelihood(seqs)
+        first_step = start_step if epoch == start_epoch else 0
+        sampler.set_epoch(epoch, start_batch=first_step)
+        optimizer.zero_grad()
+        for step, batch in tqdm(enumerate(data, first_step), total=len(data), initial=first_step):
+            if freeze:
+                log_p = transfer_model.head_likelihood(*batch)
+            else:
+                seqs, seq_lens = batch
+                log_p, _ = transfer_model.likelihood(seqs, seq_lens)
             loss = -log_p.mean()
 
-            optimizer.zero_grad()
-            loss.backward()
+            n_accum = accumulation_size(step, len(data), accum_steps)
+            (loss / n_accum).backward()
+            if (step + 1) % accum_steps != 0 and step + 1 != len(data):
+                continue
             optimizer.step()
-            if step % 80 == 0 and step != 0:
-                decrease_learning_rate(optimizer, decrease_by=0.03)
+            optimizer.zero_grad()
+            if lr_decay.step(update_size * n_accum // accum_steps):
                 tqdm.write('*'*50)
                 # tqdm.write("Epoch {:3d}   step {:3d}    loss: {:5.2f}\n".format(epoch, step, loss.data[0]))
                 tqdm.write("Epoch {:3d}   step {:3d}    loss: {:5.2f}\n".format(epoch, step, loss.data.item()))
-                seqs, likelihood, _ = transfer_model.sample(128)
-                valid = 0
-                for i, seq in enumerate(seqs.cpu().numpy()):
-                    smile = voc.decode(seq)
-                    if Chem.MolFromSmiles(smile):
-                        valid += 1
-                    if i < 5:
-                        tqdm.write(smile)
-                tqdm.write("\n{:>4.1f}% valid SMILES".format(100*valid/len(seqs)))
-                tqdm.write("*"*50 + '\n')
-                torch.save(transfer_model.rnn.state_dict(), tf_dir)
-        seqs, likelihood, _ = transfer_model.sample(1024)
-        # print("here9")
-        valid = 0
-        #valid_smis = []
-        # print("HERE")
-        for i, seq in enumerate(seqs.cpu().numpy()):
-            print("seq", seq)
-            smile = voc.decode(seq)
-            print("smile", smile)
-            if Chem.MolFromSmiles(smile):
-                try:
-                    AllChem.GetMorganFingerprintAsBitVect(Chem.MolFromSmiles(smile), 2, 1024)
-                    valid += 1
-                    smi_lst.append(smile)
-                    epoch_lst.append(epoch)
-                except:
-                    continue
+                monitor.check(transfer_model.rnn, 128, epoch, step)
+                checkpoint.save(weights())
+                state_checkpoint.save(run_state(transfer_model.rnn, optimizer, lr_decay, sampler, epoch, step + 1,
+                                                early_stopping=early_stopping.state_dict()))
+        tqdm.write("Epoch {:3d}   padding: {:4.1f}% of batch tokens".format(epoch, 100 * sampler.padding_ratio()))
+        monitor.check(transfer_model.rnn, 1024, epoch, len(data), record=True)
+        improved = False
+        if valid_moldata is not None:
+            valid_loss = validation_nll(transfer_model, valid_moldata)
+            improved = early_stopping.step(valid_loss, epoch)
+            tqdm.write("Epoch {:3d}   validation NLL: {:6.4f} per token    best: {:6.4f} (epoch {})".format(
+                epoch, valid_loss, early_stopping.best, early_stopping.best_epoch))
+
+        checkpoint.save(weights())
+        if improved:
+            best_checkpoint.save(weights())
+        state_checkpoint.save(run_state(transfer_model.rnn, optimizer, lr_decay, sampler, epoch + 1, 0,
+                                        early_stopping=early_stopping.state_dict()))
+        if early_stopping.should_stop:
+            tqdm.write("No improvement for {} epochs, stopping".format(early_stopping.bad_epochs))
+            break
+    checkpoint.close()
+    state_checkpoint.close()
+    best_checkpoint.close()
+    monitor.close()
+
 
-        torch.save(transfer_model.rnn.state_dict(), tf_dir)
+class TransferTask():
+    """One transfer set of train_multitask, with its model built on the shared
+       prior weights and its own optimizer and checkpoints"""
+    def __init__(self, model, params, data, sampler, tf_dir, tf_process_dir, adapter, keep_checkpoints=1):
+        self.model = model
+        self.data = data
+        self.sampler = sampler
+        self.tf_process_dir = tf_process_dir
+        self.adapter = adapter
+        self.optimizer = torch.optim.Adam(params, lr=scale_learning_rate(0.0005, sampler.batch_size, 10))
+        self.lr_decay = LearningRateDecay(self.optimizer, decay_every=800, decrease_by=0.03)
+        self.checkpoint = CheckpointWriter(tf_dir, keep=keep_checkpoints)
 
-    transfer_process_df = pd.DataFrame(columns=['SMILES', 'Epoch'])
-    transfer_process_df['SMILES'] = pd.Series(data=smi_lst)
-    transfer_process_df['Epoch'] = pd.Series(data=epoch_lst)
-    transfer_process_df.to_csv(tf_process_dir)
+    def weights(self):
+        if self.adapter:
+            return adapter_state_dict(self.model.rnn)
+        return self.model.rnn.state_dict()
 
 
-def sample_smiles(voc_dir, nums, outfn,tf_dir, until=False):
-    """Sample smiles using the transferred model"""
+def train_multitask(voc_dir, smi_dirs, prior_dir, tf_dirs, tf_process_dirs, freeze=False, adapter_rank=8,
+                    batch_size=10, keep_checkpoints=1):
+    """
+    Transfer learning on several sets of target molecules in one process. The
+    prior is loaded once and every task model shares its frozen weights; each
+    task only trains its own linear layer (freeze=True) or its own adapters.
+    Each step of an epoch takes one batch from every task that still has
+    batches left.
+    Args:
+        voc_dir: location of the vocabulary
+        smi_dirs: list of the SMILES files used for transfer learning, one per task
+        prior_dir: location of the prior trained model shared by the tasks
+        tf_dirs: list of the locations to save the transfer learning models
+        tf_process_dirs: list of the locations to save the SMILES sampled while doing transfer learning
+        freeze: Bool. If true, each task only trains a linear layer. The GRU outputs of the prior are then
+        computed once per molecule and shared, as in train_model(freeze=True).
+        adapter_rank: rank of the adapters trained for each task when freeze is False. The checkpoints then
+        only hold the adapters, as in train_model(adapter_rank=...).
+        batch_size: number of molecules per batch of every task
+        keep_checkpoints: number of checkpoints kept for each task
+
+    Returns: None
+
+    """
+    voc = Vocabulary(init_from_file=voc_dir)
+    prior = RNN(voc, fused=True)
+    prior.rnn.load_state_dict(torch.load(prior_dir, map_location=lambda storage, loc: storage))
+    for param in prior.rnn.parameters():
+        param.requires_grad = False
+
+    tasks = []
+    for smi_dir, tf_dir, tf_process_dir in zip(smi_dirs, tf_dirs, tf_process_dirs):
+        moldata = MolData(smi_dir, voc)
+        sampler = BucketBatchSampler(moldata.lengths(), batch_size=batch_size, drop_last=False,
+                                     seed=int(np.random.randint(2 ** 31)))
+        model = prior.shared_copy()
+        if freeze:
+            model.rnn.linear = copy.deepcopy(prior.rnn.linear).requires_grad_()
+            params = model.rnn.linear.parameters()
+            data = DataLoader(FeatureCache.build(prior, moldata), batch_sampler=sampler,
+                              collate_fn=FeatureCache.collate_fn)
+        else:
+            params = add_adapters(model.rnn, rank=adapter_rank)
+            data = DataLoader(moldata, batch_sampler=sampler, collate_fn=MolData.collate_fn)
+        if os.path.exists(tf_process_dir):
+            os.remove(tf_process_dir)
+        tasks.append(TransferTask(model, params, data, sampler, tf_dir, tf_process_dir,
+                                  adapter=not freeze, keep_checkpoints=keep_checkpoints))
+
+    # One monitor process samples from the snapshots of every task
+    monitor = ValidityMonitor(voc)
+    for epoch in range(1, 11):
+        for task in tasks:
+            task.sampler.set_epoch(epoch)
+        batches = [iter(task.data) for task in tasks]
+        for step in tqdm(range(max(len(task.data) for task in tasks))):
+            for task, task_batches in zip(tasks, batches):
+                batch = next(task_batches, None)
+                if batch is None:
+                    continue
+                if freeze:
+                    log_p = task.model.head_likelihood(*batch)
+                else:
+                    log_p, _ = task.model.likelihood(*batch)
+                loss = -log_p.mean()
+
+                loss.backward()
+                task.optimizer.step()
+                task.optimizer.zero_grad()
+                if task.lr_decay.step(batch_size):
+                    tqdm.write("{}   epoch {:3d}   step {:3d}    loss: {:5.2f}".format(
+                        task.tf_process_dir, epoch, step, loss.data.item()))
+                    monitor.check(task.model.rnn, 128, epoch, step, csv_path=task.tf_process_dir)
+                    task.checkpoint.save(task.weights())
+        for task in tasks:
+            monitor.check(task.model.rnn, 1024, epoch, len(task.data), record=True, csv_path=task.tf_process_dir)
+            task.checkpoint.save(task.weights())
+    for task in tasks:
+        task.checkpoint.close()
+    monitor.close()
+
+
+def load_model(voc_dir, tf_dir, prior_dir=None):
+    """Loads a transferred model for sampling. If tf_dir only holds adapters, they are merged into the prior
+       weights from prior_dir first. tf_dir can also be a student written by distill.py."""
     voc = Vocabulary(init_from_file=voc_dir)
-    transfer_model = RNN(voc)
-    output = open(outfn, 'w')
 
     if torch.cuda.is_available():
-        transfer_model.rnn.load_state_dict(torch.load(tf_dir))
+        state_dict = torch.load(tf_dir)
+    else:
+        state_dict = torch.load(tf_dir, map_location=lambda storage, loc:storage)
+    if 'hidden_size' in state_dict:
+        transfer_model = RNN(voc, fused=True, num_layers=state_dict['num_layers'],
+                             hidden_size=state_dict['hidden_size'])
+        if state_dict['report']:
+            tqdm.write("Distilled student:\n" + format_report(state_dict['report']))
+        state_dict = state_dict['state_dict']
     else:
-        transfer_model.rnn.load_state_dict(torch.load(tf_dir,
-                                                    map_location=lambda storage, loc:storage))
+        transfer_model = RNN(voc)
+    if is_adapter_state_dict(state_dict):
+        state_dict = merge_adapters(torch.load(prior_dir, map_location=lambda storage, loc: storage), state_dict)
+    transfer_model.rnn.load_state_dict(state_dict)
 
     for param in transfer_model.rnn.parameters():
         param.requires_grad = False
+    return transfer_model
+
+
+def sample_smiles(voc_dir, nums, outfn,tf_dir, until=False, n_workers=1, prior_dir=None, quantize=False,
+                  onnx_dir=None):
+    """Sample smiles using the transferred model, split across n_workers processes if n_workers > 1.
+       With quantize=True, samples on the CPU from the int8 quantized model (see RNN.quantized). With onnx_dir,
+       samples from that ONNX export of the model with ONNX Runtime (see export_onnx)."""
+    transfer_model = load_model(voc_dir, tf_dir, prior_dir)
+    if quantize:
+        transfer_model = transfer_model.quantized()
+    if onnx_dir:
+        transfer_model.use_onnx(onnx_dir)
+    output = open(outfn, 'w')
 
     if not until:
 
-        seqs, likelihood, _ = transfer_model.sample(nums)
-        valid = 0
+        if n_workers > 1:
+            valid = sample_parallel(transfer_model, nums, output, n_workers=n_workers)
+        else:
+            valid = sample_streaming(transfer_model, nums, output)
         double_br = 0
-        unique_idx = unique(seqs)
-        seqs = seqs[unique_idx]
-        for i, seq in enumerate(seqs.cpu().numpy()):
-
-            smile = voc.decode(seq)
-            if Chem.MolFromSmiles(smile):
-                try:
-                    AllChem.GetMorganFingerprintAsBitVect(Chem.MolFromSmiles(smile), 2, 1024)
-                    valid += 1
-                    output.write(smile+'\n')
-                except:
-                    continue
-            #if smile.count('Br') == 2:
-            #    double_br += 1
-            #output.write(smile+'\n')
         tqdm.write('\n{} molecules sampled, {} valid SMILES, {} with double Br'.format(nums, valid, double_br))
         output.close()
     else:
-        valid = 0
-        n_sample = 0
-        while valid < nums:
-            seq, likelihood, _ = transfer_model.sample(1)
-            n_sample += 1
-            seq = seq.cpu().numpy()
-            seq = seq[0]
-            # print(seq)
-            smile = voc.decode(seq)
-            if Chem.MolFromSmiles(smile):
-                try:
-                    AllChem.GetMorganFingerprintAsBitVect(Chem.MolFromSmiles(smile), 2, 1024)
-                    valid += 1
-                    output.write(smile + '\n')
-                    #if valid % 100 == 0 and valid != 0:
-                    #    tqdm.write('\n{} valid molecules sampled, with {} of total samples'.format(valid, n_sample))
-                except:
-                    continue
+        n_sample = sample_until(transfer_model, nums, output)
         tqdm.write('\n{} valid molecules sampled, with {} of total samples'.format(nums, n_sample))
+        output.close()
+
 
+def compare_quantized(voc_dir, nums, tf_dir, prior_dir=None, seed=0):
+    """Prints how the int8 quantized model compares to the float model on nums molecules sampled from seed"""
+    transfer_model = load_model(voc_dir, tf_dir, prior_dir)
+    tqdm.write(format_report(compare_models(transfer_model, transfer_model.quantized(), nums, seed)))
+
+
+def compare_speculative(voc_dir, nums, tf_dir, draft_dir, prior_dir=None, k=4, seed=0):
+    """Prints how speculative sampling with the draft model in draft_dir, e.g. a
+       distilled student, compares to plain sampling of the transferred model"""
+    transfer_model = load_model(voc_dir, tf_dir, prior_dir)
+    speculative = transfer_model.with_draft(load_model(voc_dir, draft_dir, prior_dir), k)
+    tqdm.write(format_report(compare_models(transfer_model, speculative, nums, seed)))
+    tqdm.write("Draft acceptance rate: {:.3f}   tokens per second: {:.0f}".format(
+        speculative.speculative.acceptance_rate(), speculative.speculative.tokens_per_second()))
+
+
+def export_onnx(voc_dir, tf_dir, onnx_dir, prior_dir=None, nums=64):
+    """Exports the transferred model to onnx_dir and checks the export on nums molecules"""
+    transfer_model = load_model(voc_dir, tf_dir, prior_dir)
+    transfer_model.export_onnx(onnx_dir)
+    tqdm.write("Largest log likelihood difference to the torch model on {} molecules: {:.2e}".format(
+        nums, onnx_parity(transfer_model, onnx_dir, nums)))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Transfer learning for SMILES generation")
-    parser.add_argument('--task', action='store', dest='task', choices=['train_model', 'sample_smiles'],
+    parser.add_argument('--task', action='store', dest='task', choices=['train_model', 'train_multitask', 'sample_smiles',
+                                                                    'compare_quantized', 'compare_speculative',
+                                                                    'export_onnx'],
                         default='train_model',help='What task to perform')
     parser.add_argument('--voc', action='store', dest='voc_dir',
                         default='data/Voc_danish', help='Directory for the vocabulary')
@@ -198,28 +372,72 @@ if __name__ == "__main__":
     # parser.add_argument('--smi', action='store', dest='smi_dir', default='cano_acceptors_smi.csv',
     # parser.add_argument('--smi', action='store', dest='smi_dir', default='deepsmile_test/monomer_db.csv',
     parser.add_argument('--smi', action='store', dest='smi_dir', default='LIMITED_Transfure_Database.csv',
-                        help='Directory of the SMILES file for tranfer learning')
+                        help='Directory of the SMILES file for tranfer learning, comma separated for train_multitask')
     # parser.add_argument('--prior_model', action='store', dest='prior_dir', default='data/Prior_gua_withda.ckpt',
     parser.add_argument('--prior_model', action='store', dest='prior_dir', default='data/Prior_local.ckpt',
                         help='Directory of the prior trained RNN')
     # parser.add_argument('--tf_model',action='store', dest='tf_dir', default='data/tf_model_acceptor_smi_tuneall2.ckpt',
     parser.add_argument('--tf_model',action='store', dest='tf_dir', default='data/Prior_local.ckpt',
-                        help='Directory of the transfer model')
-    parser.add_argument('--nums', action='store', dest='nums', default='1024',
+                        help='Directory of the transfer model, comma separated for train_multitask')
+    parser.add_argument('--nums', action='store', dest='nums', default='1024', type=int,
                         help='Number of SMILES to sample for transfer learning')
+    parser.add_argument('--until', action='store_true', dest='until',
+                        help='Keep sampling until nums valid, unique SMILES are saved')
+    parser.add_argument('--workers', action='store', dest='n_workers', default=1, type=int,
+                        help='Number of processes to sample with, on the CPU only')
+    parser.add_argument('--quantize', action='store_true', dest='quantize',
+                        help='Sample from the int8 quantized model')
+    parser.add_argument('--onnx', action='store', dest='onnx_dir', default=None,
+                        help='ONNX file to export the transfer model to, or to sample from with ONNX Runtime')
+    parser.add_argument('--draft', action='store', dest='draft_dir', default=None,
+                        help='Draft model for compare_speculative, e.g. a student written by distill.py')
+    parser.add_argument('--draft_k', action='store', dest='draft_k', default=4, type=int,
+                        help='Number of tokens the draft model proposes per pass')
+    parser.add_argument('--batch_size', action='store', dest='batch_size', default=10, type=int,
+                        help='Number of molecules per micro-batch for transfer learning')
+    parser.add_argument('--accum_steps', action='store', dest='accum_steps', default=1, type=int,
+                        help='Number of micro-batches accumulated per optimizer step')
+    parser.add_argument('--valid_smi', action='store', dest='valid_dir', default=None,
+                        help='Held-out SMILES file to compute the validation loss on after every epoch')
+    parser.add_argument('--patience', action='store', dest='patience', default=None, type=int,
+                        help='Stop transfer learning after this many epochs without improvement of the validation loss')
+    parser.add_argument('--freeze', action='store_true', dest='freeze',
+                        help='Only train the linear layer, on GRU outputs of the prior computed once')
+    parser.add_argument('--feature_cache', action='store', dest='feature_cache', default=None,
+                        help='With --freeze, .npy file to memory-map the cached GRU outputs to instead of keeping them in memory')
+    parser.add_argument('--adapter_rank', action='store', dest='adapter_rank', default=None, type=int,
+                        help='Freeze the prior and only train low-rank adapters of this rank (8 for train_multitask if not given)')
+    parser.add_argument('--resume', action='store', dest='resume_from', default=None,
+                        help='Run state to continue a stopped transfer run from, the --tf_model path followed by .state')
+    parser.add_argument('--keep_checkpoints', action='store', dest='keep_checkpoints', default=1, type=int,
+                        help='Number of checkpoints to keep')
     parser.add_argument('--save_smi',action='store',dest='save_dir',default='SMILES_save_smi.csv',
                         help='Directory to save the generated SMILES')
     parser.add_argument('--save_process_smi',action='store',dest='tf_process_dir',default='SMILES_transfer_process_smi.csv',
-                        help='Directory to save the generated SMILES')
+                        help='Directory to save the generated SMILES, comma separated for train_multitask')
     arg_dict = vars(parser.parse_args())
     print(arg_dict)
-    task_, voc_, smi_, prior_, tf_, nums_, save_smi_, tf_process_dir_ = arg_dict.values()
+    task_, voc_, smi_, prior_, tf_, nums_, until_, n_workers_, quantize_, onnx_, draft_, draft_k_, batch_size_, accum_steps_, valid_, patience_, freeze_, feature_cache_, adapter_rank_, resume_, keep_checkpoints_, save_smi_, tf_process_dir_ = arg_dict.values()
     print("voc_: ", voc_)
 
     if task_ == 'train_model':
         train_model(voc_dir=voc_, smi_dir=smi_, prior_dir=prior_, tf_dir=tf_,
-                    tf_process_dir=tf_process_dir_,freeze=False)
+                    tf_process_dir=tf_process_dir_,freeze=freeze_, batch_size=batch_size_,
+                    accum_steps=accum_steps_, valid_dir=valid_, patience=patience_,
+                    keep_checkpoints=keep_checkpoints_, resume_from=resume_,
+                    feature_cache=feature_cache_, adapter_rank=adapter_rank_)
+    if task_ == 'train_multitask':
+        train_multitask(voc_dir=voc_, smi_dirs=smi_.split(','), prior_dir=prior_, tf_dirs=tf_.split(','),
+                        tf_process_dirs=tf_process_dir_.split(','), freeze=freeze_,
+                        adapter_rank=adapter_rank_ or 8, batch_size=batch_size_, keep_checkpoints=keep_checkpoints_)
     if task_ == 'sample_smiles':
-        sample_smiles(voc_, nums_,save_smi_,tf_, until=False)
+        sample_smiles(voc_, nums_,save_smi_,tf_, until=until_, n_workers=n_workers_, prior_dir=prior_,
+                      quantize=quantize_, onnx_dir=onnx_)
+    if task_ == 'compare_quantized':
+        compare_quantized(voc_, nums_, tf_, prior_dir=prior_)
+    if task_ == 'compare_speculative':
+        compare_speculative(voc_, nums_, tf_, draft_, prior_dir=prior_, k=draft_k_)
+    if task_ == 'export_onnx':
+        export_onnx(voc_, tf_, onnx_, prior_dir=prior_)
 
 
@@ -1,10 +1,13 @@
 import torch
+import torch.distributed as dist
 import numpy as np
 from rdkit import Chem
 
 def Variable(tensor):
     """
-    Wrapper function to generate torch tensor and assign to GPU if available
+    Wrapper function to generate torch tensor and assign to GPU if available.
+    Input data never requires gradients; copies from pinned memory are
+    non-blocking.
     Args:
         tensor: input tensor
 
@@ -13,9 +16,8 @@ def Variable(tensor):
     """
     if isinstance(tensor, np.ndarray):
         tensor = torch.from_numpy(tensor)
-        tensor.requires_grad = True
     if torch.cuda.is_available():
-        tensor = tensor.cuda()
+        tensor = tensor.cuda(non_blocking=True)
     return tensor 
 
 
@@ -33,6 +35,58 @@ def decrease_learning_rate(optimizer, decrease_by=0.01):
         param_group['lr'] *= (1 - decrease_by)
 
 
+def scale_learning_rate(lr, batch_size, base_batch_size):
+    """
+    Scales a learning rate tuned at base_batch_size to a new effective batch
+    size, using the square root rule that suits Adam
+    Args:
+        lr: learning rate tuned at base_batch_size
+        batch_size: effective number of molecules per optimizer step
+        base_batch_size: batch size the learning rate was tuned at
+
+    Returns: scaled learning rate
+
+    """
+    return lr * (batch_size / base_batch_size) ** 0.5
+
+
+def accumulation_size(step, n_batches, accum_steps):
+    """
+    Number of micro-batches accumulated into the optimizer step that a batch
+    belongs to. A step is taken every accum_steps batches and after the last
+    batch of an epoch, which gets the n_batches % accum_steps batches left over.
+    Args:
+        step: index of the batch in the epoch
+        n_batches: number of batches in the epoch
+        accum_steps: number of micro-batches per optimizer step
+
+    Returns: number of micro-batches of the optimizer step, to divide the loss by
+
+    """
+    remainder = n_batches % accum_steps
+    if remainder and step >= n_batches - remainder:
+        return remainder
+    return accum_steps
+
+
+class LearningRateDecay():
+    """Multiplies the learning rate by (1 - decrease_by) once every decay_every
+       training molecules, independent of the batch size used to see them."""
+    def __init__(self, optimizer, decay_every, decrease_by=0.03):
+        self.optimizer = optimizer
+        self.decay_every = decay_every
+        self.decrease_by = decrease_by
+        self.samples = 0
+
+    def step(self, n_samples):
+        """Counts n_samples more training molecules and returns the number of decays applied"""
+        decays = (self.samples + n_samples) // self.decay_every - self.samples // self.decay_every
+        self.samples += n_samples
+        for _ in range(decays):
+            decrease_learning_rate(self.optimizer, decrease_by=self.decrease_by)
+        return decays
+
+
 def seq_to_smiles(seqs, voc):
     """
     Takes an output sequence from RNN and returns the smiles
@@ -80,3 +134,23 @@ def unique(arr):
     if torch.cuda.is_available():
         return torch.LongTensor(np.sort(idxs)).cuda()
     return torch.LongTensor(np.sort(idxs))
+
+
+def allreduce_gradients(model):
+    """
+    Averages the gradients of model over all processes of the default
+    torch.distributed process group, using a single flattened all-reduce
+    Args:
+        model: nn.Module whose gradients are averaged in place
+
+    Returns: None
+
+    """
+    grads = [param.grad for param in model.parameters() if param.grad is not None]
+    flat = torch.cat([grad.view(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
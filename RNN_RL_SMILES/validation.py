@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import math
+import torch
+from torch.utils.data import DataLoader
+
+from data_structs import BucketBatchSampler
+
+
+def validation_nll(model, moldata, batch_size=512):
+    """
+    Computes the mean negative log likelihood per token of a held-out dataset.
+    The sequences are run without gradients in large batches of similar
+    length, and the padding of each batch is masked out of the loss.
+    Args:
+        model: RNN to evaluate
+        moldata: MolData or TokenizedMolData with the held-out SMILES
+        batch_size: number of molecules per batch
+
+    Returns: mean NLL per token, including the END token of every sequence
+
+    """
+    sampler = BucketBatchSampler(moldata.lengths(), batch_size=batch_size, seed=0)
+    # Keep the sequences as a list so likelihood() masks the padding
+    data = DataLoader(moldata, batch_sampler=sampler, collate_fn=list)
+    nll, n_tokens = 0.0, 0
+    with torch.no_grad():
+        for seqs in data:
+            log_p, _ = model.likelihood(seqs)
+            nll -= log_p.sum().item()
+            n_tokens += sum(len(seq) for seq in seqs)
+    return nll / n_tokens
+
+
+class EarlyStopping():
+    """Keeps track of the best validation loss of a run. An epoch improves on
+       the best loss if it is lower by more than min_delta; once patience
+       epochs in a row have not improved, should_stop is True.
+
+        Args:
+                patience : number of epochs without improvement before stopping, None to never stop
+                min_delta : smallest decrease of the loss that counts as an improvement
+    """
+    def __init__(self, patience=None, min_delta=0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = math.inf
+        self.best_epoch = None
+        self.bad_epochs = 0
+
+    def step(self, loss, epoch):
+        """Records the validation loss of an epoch, returns True if it is the best so far"""
+        if loss < self.best - self.min_delta:
+            self.best = loss
+            self.best_epoch = epoch
+            self.bad_epochs = 0
+            return True
+        self.bad_epochs += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return self.patience is not None and self.bad_epochs >= self.patience
+
+    def state_dict(self):
+        return {'best': self.best, 'best_epoch': self.best_epoch, 'bad_epochs': self.bad_epochs}
+
+    def load_state_dict(self, state_dict):
+        self.best = state_dict['best']
+        self.best_epoch = state_dict['best_epoch']
+        self.bad_epochs = state_dict['bad_epochs']